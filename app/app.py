@@ -1,16 +1,5 @@
 import streamlit as st
 import os
-from pathlib import Path
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains import create_retrieval_chain
-from langchain_gigachat.chat_models import GigaChat
-from langchain_gigachat.embeddings.gigachat import GigaChatEmbeddings
-from langchain.embeddings import HuggingFaceEmbeddings
-from vectorization.v_a_c import SmartCodeDocSystem, SmartRetriever, create_smart_prompt
-import os
-
-from dotenv import load_dotenv
-load_dotenv()
 
 
 st.set_page_config(
@@ -22,36 +11,21 @@ st.set_page_config(
 st.title("LangChain RAG Assistant")
 st.markdown("Задайте вопрос о библиотеке LangChain")
 
-API_KEY = os.getenv("GIGACHAT_CREDENTIALS")
 VECTOR_STORE_PATH = os.path.join(os.path.dirname(__file__), "langchain_vector_store")
 
 
 @st.cache_resource
 def initialize_rag_system():
-    """Инициализация RAG системы с кэшированием"""
-    try:
-        embeddings = GigaChatEmbeddings(
-            credentials=API_KEY,
-            scope="GIGACHAT_API_PERS",
-            verify_ssl_certs=False,
-        )
-
-        system = SmartCodeDocSystem(embeddings, chunk_size=600, chunk_overlap=100)
-        
-        system.load_vector_store(VECTOR_STORE_PATH)
+    """Инициализация RAG системы с кэшированием.
 
-        llm = GigaChat(
-            credentials=API_KEY,
-            verify_ssl_certs=False,
-            model="GigaChat-Max"
-        )
-
-        smart_retriever = SmartRetriever(smart_system=system, k=150)
-        prompt = create_smart_prompt()
-        document_chain = create_stuff_documents_chain(llm=llm, prompt=prompt)
-        retrieval_chain = create_retrieval_chain(smart_retriever, document_chain)
+    Цепочка собирается той же фабрикой, что и headless-сервис; тяжелые модули
+    импортируются здесь, чтобы страница отрисовывалась сразу.
+    """
+    try:
+        from service import create_service
 
-        return retrieval_chain, system
+        service = create_service(VECTOR_STORE_PATH)
+        return service.chain, service.system
 
     except Exception as e:
         st.error(f"Ошибка при инициализации системы: {e}")
@@ -97,8 +71,7 @@ def main():
             with st.spinner("Поиск ответа..."):
                 try:
                     response = retrieval_chain.invoke({'input': user_question})
-
-                    search_result = system.smart_search(user_question, k=150)
+                    search_result = response['search_result']
 
                     st.markdown("---")
                     st.subheader("Ответ")
@@ -141,8 +114,23 @@ def main():
                     with st.expander("Детали поиска"):
                         st.markdown(f"**Тип поиска:** {search_result.search_type}")
                         st.markdown(f"**Всего найдено документов:** {len(search_result.documents)}")
-
-                        if hasattr(search_result, 'scores') and search_result.scores:
+                        if search_result.code_ratio is not None:
+                            st.markdown(f"**Доля кода по эмбеддингу запроса:** {search_result.code_ratio:.2f}")
+
+                        if search_result.timings:
+                            st.markdown("**Время этапов:**")
+                            st.table({
+                                "Этап": list(search_result.timings),
+                                "мс": [round(ms, 1) for ms in search_result.timings.values()],
+                            })
+                            st.markdown(f"**Всего:** {sum(search_result.timings.values()):.0f} мс")
+
+                        if search_result.counters:
+                            st.markdown("**Счетчики:**")
+                            for name, value in search_result.counters.items():
+                                st.markdown(f"- {name}: {value}")
+
+                        if search_result.scores:
                             st.markdown("**Релевантность документов:**")
                             for i, score in enumerate(search_result.scores):
                                 st.progress(min(score, 1.0), text=f"Документ {i + 1}: {score:.3f}")
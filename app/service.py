@@ -0,0 +1,359 @@
+"""Headless-режим RAG ассистента: HTTP сервис и пакетная обработка вопросов.
+
+Примеры запуска:
+    python service.py serve --port 8000
+    python service.py batch questions.txt --output answers.jsonl
+
+Метрики в формате Prometheus доступны по GET /metrics.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, List, Optional
+
+from dotenv import load_dotenv
+from langchain.chains.combine_documents import create_stuff_documents_chain
+
+from vectorization.v_a_c import (
+    AnswerCache,
+    CachedEmbeddings,
+    RetrievalMetrics,
+    SearchResult,
+    SmartCodeDocSystem,
+    SmartRetriever,
+    create_smart_prompt,
+    create_smart_retrieval_chain,
+    record_answer,
+)
+
+load_dotenv()
+
+API_KEY = os.getenv("GIGACHAT_CREDENTIALS")
+VECTOR_STORE_PATH = os.path.join(os.path.dirname(__file__), "langchain_vector_store")
+EMBEDDING_CACHE_PATH = os.path.join(os.path.dirname(__file__), "embedding_cache.sqlite")
+EMBEDDING_CACHE_TTL = 7 * 24 * 3600
+CONTEXT_TOKEN_BUDGET = 6000
+ANSWER_CACHE_PATH = os.path.join(os.path.dirname(__file__), "answer_cache.sqlite")
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.split())
+
+
+def serialize_result(question: str, answer: str, search_result: SearchResult) -> dict:
+    """Приводит ответ цепочки к JSON-совместимому виду"""
+    sources = []
+    for i, doc in enumerate(search_result.documents):
+        sources.append({
+            "type": doc.metadata.get("type"),
+            "relative_path": doc.metadata.get("relative_path"),
+            "chunk_index": doc.metadata.get("chunk_index"),
+            "score": search_result.scores[i] if i < len(search_result.scores) else None,
+        })
+    return {
+        "question": question,
+        "answer": answer,
+        "search_type": search_result.search_type,
+        "code_ratio": search_result.code_ratio,
+        "sources": sources,
+        "timings_ms": {stage: round(ms, 3) for stage, ms in search_result.timings.items()},
+        "counters": search_result.counters,
+    }
+
+
+class RAGService:
+    """Цепочка SmartCodeDocSystem + SmartRetriever + LLM для работы без UI.
+
+    Индекс загружается один раз на процесс; все потоки сервера используют
+    один и тот же экземпляр.
+    """
+
+    def __init__(self, system: SmartCodeDocSystem, llm, k: int = 150, max_concurrency: int = 4,
+                 token_budget: Optional[int] = CONTEXT_TOKEN_BUDGET, answer_cache: Optional[AnswerCache] = None,
+                 metrics: Optional[RetrievalMetrics] = None):
+        self.system = system
+        self.k = k
+        self.max_concurrency = max_concurrency
+        self.answer_cache = answer_cache
+        self.metrics = metrics or RetrievalMetrics()
+        self.retriever = SmartRetriever(smart_system=system, k=k, token_budget=token_budget)
+        self.document_chain = create_stuff_documents_chain(llm=llm, prompt=create_smart_prompt())
+        self.chain = create_smart_retrieval_chain(self.retriever, self.document_chain, answer_cache, self.metrics)
+
+    def answer(self, question: str) -> dict:
+        question = normalize_question(question)
+        response = self.chain.invoke({"input": question})
+        return serialize_result(question, response["answer"], response["search_result"])
+
+    def answer_batch(self, questions: List[str]) -> List[dict]:
+        """Отвечает на набор вопросов: дубликаты обрабатываются один раз,
+        генерация ответов идет пакетом с ограничением параллельности"""
+        normalized = [normalize_question(q) for q in questions]
+        unique_questions = list(dict.fromkeys(normalized))
+
+        search_results = [
+            self.retriever.pack(result)
+            for result in self.system.smart_search_batch(unique_questions, k=self.k)
+        ]
+
+        answers: List[Optional[str]] = [None] * len(unique_questions)
+        keys = [None] * len(unique_questions)
+        index_version = self.system.index_version
+        if self.answer_cache is not None:
+            self.answer_cache.sync_version(index_version)
+            for i, (question, result) in enumerate(zip(unique_questions, search_results)):
+                keys[i] = self.answer_cache.key(question, result.documents, index_version)
+                answers[i] = self.answer_cache.get(keys[i])
+
+        pending = [i for i, answer in enumerate(answers) if answer is None]
+        runs = {}
+
+        def collect_run(run):
+            runs[run.inputs["input"]] = run
+
+        generated = self.document_chain.with_listeners(on_end=collect_run).batch(
+            [{"input": unique_questions[i], "context": search_results[i].documents} for i in pending],
+            config={"max_concurrency": self.max_concurrency},
+        )
+        for i, answer in zip(pending, generated):
+            answers[i] = answer
+            if self.answer_cache is not None:
+                self.answer_cache.put(keys[i], index_version, answer)
+
+        generated_ids = set(pending)
+        for i, (question, answer, result) in enumerate(zip(unique_questions, answers, search_results)):
+            record_answer(result, question, answer, None if i in generated_ids else 0.0,
+                          cached=None if self.answer_cache is None else i not in generated_ids,
+                          run=runs.get(question) if i in generated_ids else None)
+            self.metrics.observe(result)
+
+        by_question = {
+            question: serialize_result(question, answer, result)
+            for question, answer, result in zip(unique_questions, answers, search_results)
+        }
+        return [by_question[question] for question in normalized]
+
+    def render_metrics(self) -> str:
+        """Метрики запросов и статистика кэшей в формате Prometheus"""
+        caches = {}
+        embedding_cache_info = getattr(self.system.embeddings, "cache_info", None)
+        if embedding_cache_info is not None:
+            caches["embedding"] = embedding_cache_info()
+        if self.answer_cache is not None:
+            caches["answer"] = self.answer_cache.cache_info()
+        return self.metrics.render_prometheus(caches=caches)
+
+    def stream(self, question: str) -> Iterator[str]:
+        """Отдает ответ по токенам"""
+        for chunk in self.chain.stream({"input": normalize_question(question)}):
+            if "answer" in chunk:
+                yield chunk["answer"]
+
+
+def create_service(vector_store_path: str = VECTOR_STORE_PATH, k: int = 150, max_concurrency: int = 4,
+                   token_budget: Optional[int] = CONTEXT_TOKEN_BUDGET,
+                   answer_cache_path: Optional[str] = ANSWER_CACHE_PATH,
+                   metrics_log_path: Optional[str] = None) -> RAGService:
+    """Создает сервис с эмбеддингами и моделью GigaChat"""
+    from langchain_gigachat.chat_models import GigaChat
+    from langchain_gigachat.embeddings.gigachat import GigaChatEmbeddings
+
+    embeddings = CachedEmbeddings(
+        GigaChatEmbeddings(
+            credentials=API_KEY,
+            scope="GIGACHAT_API_PERS",
+            verify_ssl_certs=False,
+        ),
+        max_size=5000,
+        ttl=EMBEDDING_CACHE_TTL,
+        db_path=EMBEDDING_CACHE_PATH,
+    )
+
+    system = SmartCodeDocSystem(embeddings, chunk_size=600, chunk_overlap=100)
+    if not system.load_vector_store(vector_store_path):
+        raise RuntimeError(f"Не удалось загрузить векторное хранилище из {vector_store_path}")
+
+    llm = GigaChat(
+        credentials=API_KEY,
+        verify_ssl_certs=False,
+        model="GigaChat-Max"
+    )
+    answer_cache = AnswerCache(answer_cache_path, max_entries=1000) if answer_cache_path else None
+    return RAGService(system, llm, k=k, max_concurrency=max_concurrency, token_budget=token_budget,
+                      answer_cache=answer_cache, metrics=RetrievalMetrics(metrics_log_path))
+
+
+class RAGRequestHandler(BaseHTTPRequestHandler):
+    """HTTP обработчик.
+
+    GET  /health  — проверка готовности
+    GET  /metrics — метрики в формате Prometheus
+    POST /query   — {"question": "..."}
+    POST /batch   — {"questions": ["...", ...]}
+    POST /stream  — {"question": "..."}, ответ передается по частям
+    """
+
+    protocol_version = "HTTP/1.1"
+    service: RAGService = None
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, status: int, text: str, content_type: str = "text/plain; charset=utf-8"):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            self._send_text(200, self.service.render_metrics(), "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        try:
+            payload = self._read_json()
+        except ValueError as e:
+            self._send_json(400, {"error": f"некорректный JSON: {e}"})
+            return
+        if not isinstance(payload, dict):
+            self._send_json(400, {"error": "тело запроса должно быть JSON-объектом"})
+            return
+
+        try:
+            if self.path == "/query":
+                question = payload.get("question", "")
+                if not isinstance(question, str) or not question.strip():
+                    self._send_json(400, {"error": "question должен быть непустой строкой"})
+                    return
+                self._send_json(200, self.service.answer(question))
+
+            elif self.path == "/batch":
+                questions = payload.get("questions") or []
+                if not isinstance(questions, list) or not all(isinstance(q, str) and q.strip() for q in questions):
+                    self._send_json(400, {"error": "questions должен быть списком непустых строк"})
+                    return
+                self._send_json(200, {"results": self.service.answer_batch(questions)})
+
+            elif self.path == "/stream":
+                question = payload.get("question", "")
+                if not isinstance(question, str) or not question.strip():
+                    self._send_json(400, {"error": "question должен быть непустой строкой"})
+                    return
+                self._stream(self.service.stream(question))
+
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+
+    def _stream(self, tokens: Iterator[str]):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for token in tokens:
+                data = token.encode("utf-8")
+                if data:
+                    self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+                    self.wfile.flush()
+        except OSError as e:
+            # Клиент закрыл соединение: завершающий чанк писать некуда, а ответ
+            # об ошибке после уже отправленных заголовков 200 невозможен
+            print(f"Клиент отключился во время потоковой передачи: {e}")
+            self.close_connection = True
+            return
+        except Exception as e:
+            print(f"Ошибка при потоковой генерации ответа: {e}")
+        try:
+            self.wfile.write(b"0\r\n\r\n")
+        except OSError:
+            self.close_connection = True
+
+
+def serve(service: RAGService, host: str = "127.0.0.1", port: int = 8000):
+    """Запускает многопоточный HTTP сервер с общим экземпляром сервиса"""
+    RAGRequestHandler.service = service
+    server = ThreadingHTTPServer((host, port), RAGRequestHandler)
+    print(f"Сервис запущен на http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def run_batch(service: RAGService, questions_path: str, output_path: str, batch_size: int = 32):
+    """Офлайн-прогон вопросов из файла (по одному на строку) с записью ответов в JSONL"""
+    with open(questions_path, encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+    print(f"Загружено {len(questions)} вопросов")
+    start = time.perf_counter()
+    with open(output_path, "w", encoding="utf-8") as out:
+        for i in range(0, len(questions), batch_size):
+            batch_start = time.perf_counter()
+            results = service.answer_batch(questions[i:i + batch_size])
+            elapsed = time.perf_counter() - batch_start
+            for result in results:
+                result["batch_seconds"] = round(elapsed, 3)
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            print(f"  Обработано {min(i + batch_size, len(questions))}/{len(questions)} вопросов")
+
+    print(f"Готово за {time.perf_counter() - start:.1f} с, результаты в {output_path}")
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Headless режим LangChain RAG Assistant")
+    parser.add_argument("--vector-store", default=VECTOR_STORE_PATH, help="Путь к векторному хранилищу")
+    parser.add_argument("--k", type=int, default=150, help="Число чанков контекста")
+    parser.add_argument("--concurrency", type=int, default=4, help="Параллельные запросы к LLM")
+    parser.add_argument("--token-budget", type=int, default=CONTEXT_TOKEN_BUDGET,
+                        help="Бюджет токенов контекста (0 — без упаковки)")
+    parser.add_argument("--no-answer-cache", action="store_true", help="Не кэшировать ответы")
+    parser.add_argument("--metrics-log", help="Писать метрики каждого запроса в файл JSONL")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Запустить HTTP сервис")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+
+    batch_parser = subparsers.add_parser("batch", help="Ответить на вопросы из файла")
+    batch_parser.add_argument("questions", help="Файл с вопросами, по одному на строку")
+    batch_parser.add_argument("--output", default="answers.jsonl", help="Файл результатов JSONL")
+    batch_parser.add_argument("--batch-size", type=int, default=32)
+
+    args = parser.parse_args(argv)
+    service = create_service(args.vector_store, k=args.k, max_concurrency=args.concurrency,
+                             token_budget=args.token_budget or None,
+                             answer_cache_path=None if args.no_answer_cache else ANSWER_CACHE_PATH,
+                             metrics_log_path=args.metrics_log)
+
+    if args.command == "serve":
+        serve(service, args.host, args.port)
+    else:
+        run_batch(service, args.questions, args.output, args.batch_size)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
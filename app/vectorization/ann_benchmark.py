@@ -0,0 +1,169 @@
+"""Сравнение типов FAISS индексов на векторах готового хранилища.
+
+Для каждого раздела (code / doc) векторы извлекаются из сохраненного индекса,
+точный Flat индекс служит эталоном, а для каждого кандидата измеряются
+recall@k, задержка поиска p50/p99, время построения и размер индекса.
+
+Пример:
+    python -m vectorization.ann_benchmark langchain_vector_store --k 10 \
+        --index-types hnsw ivf_flat ivf_pq sq8 --nprobe 8 16 32 --ef-search 32 64 128
+"""
+import os
+import json
+import time
+import argparse
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from vectorization.v_a_c import CONTENT_TYPES, INDEX_TYPES, IndexConfig, apply_search_params, build_faiss_index
+
+
+def load_partition_vectors(store_path: str, doc_type: str) -> Optional[np.ndarray]:
+    """Извлекает все векторы раздела из сохраненного индекса"""
+    import faiss
+
+    index_path = os.path.join(store_path, doc_type, "index.faiss")
+    if not os.path.exists(index_path):
+        return None
+    index = faiss.read_index(index_path)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def sample_queries(vectors: np.ndarray, n_queries: int, noise: float = 0.05, seed: int = 0) -> np.ndarray:
+    """Запросы — случайные векторы корпуса с небольшим шумом, чтобы не совпадать с ними точно"""
+    rng = np.random.default_rng(seed)
+    picked = vectors[rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)]
+    queries = picked + rng.normal(scale=noise, size=picked.shape).astype(np.float32)
+    norms = np.linalg.norm(queries, axis=1, keepdims=True)
+    return (queries / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def measure(index, queries: np.ndarray, ground_truth: np.ndarray, k: int) -> Dict[str, float]:
+    """recall@k относительно эталона и задержка одиночных запросов"""
+    latencies = []
+    hits = 0
+    for query, truth in zip(queries, ground_truth):
+        start = time.perf_counter()
+        _, found = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(set(found[0].tolist()) & set(truth.tolist()))
+    return {
+        "recall_at_k": hits / (len(queries) * k),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def index_size_bytes(index) -> int:
+    import faiss
+
+    return int(faiss.serialize_index(index).size)
+
+
+def index_class_name(index) -> str:
+    import faiss
+
+    return type(faiss.downcast_index(index)).__name__
+
+
+def benchmark_partition(vectors: np.ndarray, queries: np.ndarray, k: int, index_types: List[str],
+                        nprobes: List[int], ef_searches: List[int], base_config: IndexConfig) -> List[dict]:
+    import faiss
+
+    rows = []
+    flat_start = time.perf_counter()
+    flat = build_faiss_index(vectors, IndexConfig(index_type="flat"))
+    flat_build = time.perf_counter() - flat_start
+    _, ground_truth = flat.search(queries, k)
+
+    row = {"index_type": "flat", "faiss_index": index_class_name(flat), "param": "",
+           "build_s": flat_build, "size_mb": index_size_bytes(flat) / 2 ** 20}
+    row.update(measure(flat, queries, ground_truth, k))
+    rows.append(row)
+
+    for index_type in index_types:
+        config = IndexConfig(**{**base_config.__dict__, "index_type": index_type})
+        start = time.perf_counter()
+        index = build_faiss_index(vectors, config)
+        build_s = time.perf_counter() - start
+        size_mb = index_size_bytes(index) / 2 ** 20
+
+        if isinstance(index, faiss.IndexFlat):
+            # Векторов не хватило для обучения, build_faiss_index вернул точный индекс:
+            # перебор nprobe / efSearch ничего бы не менял
+            row = {"index_type": index_type, "faiss_index": index_class_name(index), "param": "fallback flat",
+                   "build_s": build_s, "size_mb": size_mb}
+            row.update(measure(index, queries, ground_truth, k))
+            rows.append(row)
+            continue
+
+        if index_type in ("ivf_flat", "ivf_pq"):
+            sweep = [("nprobe", value) for value in nprobes]
+        elif index_type == "hnsw":
+            sweep = [("efSearch", value) for value in ef_searches]
+        else:
+            sweep = [("", None)]
+
+        for name, value in sweep:
+            if name == "nprobe":
+                config.nprobe = value
+            elif name == "efSearch":
+                config.ef_search = value
+            apply_search_params(index, config)
+            row = {
+                "index_type": index_type,
+                "faiss_index": index_class_name(index),
+                "param": f"{name}={value}" if name else "",
+                "build_s": build_s,
+                "size_mb": size_mb,
+            }
+            row.update(measure(index, queries, ground_truth, k))
+            rows.append(row)
+    return rows
+
+
+def print_rows(doc_type: str, n_vectors: int, k: int, rows: List[dict]):
+    print(f"\nРаздел {doc_type}: {n_vectors} векторов, recall@{k}")
+    print(f"{'индекс':<10} {'FAISS':<22} {'параметр':<14} {'recall':>7} {'p50, мс':>9} {'p99, мс':>9} {'сборка, с':>10} {'размер, МБ':>11}")
+    for row in rows:
+        print(f"{row['index_type']:<10} {row['faiss_index']:<22} {row['param']:<14} {row['recall_at_k']:>7.3f} {row['p50_ms']:>9.3f} "
+              f"{row['p99_ms']:>9.3f} {row['build_s']:>10.2f} {row['size_mb']:>11.2f}")
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Recall и задержка ANN индексов относительно точного поиска")
+    parser.add_argument("vector_store", help="Путь к сохраненному векторному хранилищу")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=500, help="Число запросов из векторов корпуса")
+    parser.add_argument("--queries-file", help="Файл .npy с эмбеддингами реальных запросов")
+    parser.add_argument("--index-types", nargs="+", default=[t for t in INDEX_TYPES if t != "flat"],
+                        choices=[t for t in INDEX_TYPES if t != "flat"])
+    parser.add_argument("--nprobe", nargs="+", type=int, default=[4, 16, 64])
+    parser.add_argument("--ef-search", nargs="+", type=int, default=[32, 64, 128])
+    parser.add_argument("--nlist", type=int, default=IndexConfig.nlist)
+    parser.add_argument("--pq-m", type=int, default=IndexConfig.pq_m)
+    parser.add_argument("--output", help="Сохранить результаты в JSON")
+    args = parser.parse_args(argv)
+
+    base_config = IndexConfig(nlist=args.nlist, pq_m=args.pq_m)
+    external_queries = np.load(args.queries_file).astype(np.float32) if args.queries_file else None
+
+    report = {}
+    for doc_type in CONTENT_TYPES:
+        vectors = load_partition_vectors(args.vector_store, doc_type)
+        if vectors is None or len(vectors) == 0:
+            continue
+        queries = external_queries if external_queries is not None else sample_queries(vectors, args.queries)
+        rows = benchmark_partition(vectors, queries, args.k, args.index_types, args.nprobe, args.ef_search, base_config)
+        print_rows(doc_type, len(vectors), args.k, rows)
+        report[doc_type] = rows
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""Фикстура для проверки покрытия строк при разбиении кода по AST."""
+import os
+
+# IMPORTANT: must be called before init()
+# Читает настройки из окружения один раз на процесс.
+def load_settings():
+    return {"credentials": os.getenv("GIGACHAT_CREDENTIALS")}
+
+
+# Значение по умолчанию для размера батча
+BATCH_SIZE = 64
+
+
+class Loader:
+    """Загрузчик текстовых файлов."""
+
+    encoding = "utf-8"
+
+    # Путь хранится как есть, без нормализации
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    # Сеттер проверяет расширение
+    @name.setter
+    def name(self, value):
+        if not value.endswith(".txt"):
+            raise ValueError(value)
+        self.path = os.path.join(os.path.dirname(self.path), value)
+
+    # Комментарий в конце тела класса
+
+
+async def aload(path):
+    # Комментарий внутри функции
+    return Loader(path)
+
+# Комментарий в конце файла
+# TODO: поддержать кодировки кроме utf-8
@@ -0,0 +1,30 @@
+"""Фикстура с разделителями строк, которые ast не считает переводом строки."""
+import os
+
+# Раздел: чтение настроек
+def read_settings():
+    """Настройки из окружения."""
+    return {"home": os.getenv("HOME")}
+
+
+# Раздел: константы
+SEPARATOR = " "
+VERTICAL_TAB = ""
+
+
+class Reader:
+    """Читает файлпо частям."""
+
+    def __init__(self, path):
+        self.path = path
+
+    # Комментарий перед методом
+    def read(self):
+        with open(self.path, encoding="utf-8") as f:
+            return f.read()
+
+
+def join_lines(lines):
+    return SEPARATOR.join(lines)
+
+# Комментарий в конце файла
@@ -0,0 +1,19 @@
+"""Loaders for PDF files."""
+from typing import List
+
+
+class PyPDFLoader:
+    """Load a PDF with pypdf, one Document per page with the page number in metadata."""
+
+    def __init__(self, file_path: str, password: str = None):
+        self.file_path = file_path
+        self.password = password
+
+    def load(self) -> List[dict]:
+        import pypdf
+
+        reader = pypdf.PdfReader(self.file_path, password=self.password)
+        return [
+            {"page_content": page.extract_text(), "metadata": {"source": self.file_path, "page": number}}
+            for number, page in enumerate(reader.pages)
+        ]
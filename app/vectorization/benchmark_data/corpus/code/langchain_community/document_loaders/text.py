@@ -0,0 +1,25 @@
+"""Loader for plain text files."""
+from typing import List, Optional
+
+
+class TextLoader:
+    """Load a text file into a single Document.
+
+    file_path: path to the file.
+    encoding: file encoding; when autodetect_encoding is True the loader
+    tries to detect it if decoding fails.
+    """
+
+    def __init__(self, file_path: str, encoding: Optional[str] = None, autodetect_encoding: bool = False):
+        self.file_path = file_path
+        self.encoding = encoding
+        self.autodetect_encoding = autodetect_encoding
+
+    def load(self) -> List["Document"]:
+        """Read the file and return a list with one Document whose metadata has the source path."""
+        with open(self.file_path, encoding=self.encoding) as f:
+            text = f.read()
+        return [{"page_content": text, "metadata": {"source": self.file_path}}]
+
+    def lazy_load(self):
+        yield from self.load()
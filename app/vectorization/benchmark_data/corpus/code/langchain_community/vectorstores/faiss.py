@@ -0,0 +1,41 @@
+"""FAISS vector store."""
+from typing import List, Optional
+
+from langchain_core.vectorstores.base import VectorStore
+
+
+class FAISS(VectorStore):
+    """Vector store on top of the faiss library.
+
+    Build it with FAISS.from_documents(documents, embeddings), persist it with
+    save_local and restore it with load_local.
+    """
+
+    def __init__(self, embedding_function, index, docstore, index_to_docstore_id):
+        self.embedding_function = embedding_function
+        self.index = index
+        self.docstore = docstore
+        self.index_to_docstore_id = index_to_docstore_id
+
+    @classmethod
+    def from_documents(cls, documents: list, embedding) -> "FAISS":
+        import faiss
+
+        vectors = embedding.embed_documents([doc.page_content for doc in documents])
+        index = faiss.IndexFlatL2(len(vectors[0]))
+        index.add(vectors)
+        docstore = {str(i): doc for i, doc in enumerate(documents)}
+        return cls(embedding.embed_query, index, docstore, {i: str(i) for i in range(len(documents))})
+
+    def similarity_search(self, query: str, k: int = 4) -> List["Document"]:
+        _, indices = self.index.search([self.embedding_function(query)], k)
+        return [self.docstore[self.index_to_docstore_id[i]] for i in indices[0] if i != -1]
+
+    def save_local(self, folder_path: str, index_name: str = "index") -> None:
+        import faiss
+
+        faiss.write_index(self.index, f"{folder_path}/{index_name}.faiss")
+
+    @classmethod
+    def load_local(cls, folder_path: str, embeddings, allow_dangerous_deserialization: bool = False) -> "FAISS":
+        raise NotImplementedError
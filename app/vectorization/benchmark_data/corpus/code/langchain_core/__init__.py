@@ -0,0 +1,7 @@
+"""langchain_core: base abstractions of LangChain.
+
+Packages: documents, prompts, runnables, retrievers, vectorstores, tools,
+language_models, output_parsers and callbacks.
+"""
+__all__ = ["documents", "prompts", "runnables", "retrievers", "vectorstores", "tools",
+           "language_models", "output_parsers", "callbacks"]
@@ -0,0 +1,24 @@
+"""Callback manager that dispatches run events to handlers."""
+from typing import List
+from uuid import uuid4
+
+
+class CallbackManager:
+    """Notifies every handler about chain, tool and LLM run start, end and error events."""
+
+    def __init__(self, handlers: List = None):
+        self.handlers = handlers or []
+
+    def on_chain_start(self, serialized: dict, inputs: dict) -> str:
+        run_id = str(uuid4())
+        for handler in self.handlers:
+            handler.on_chain_start(serialized, inputs, run_id=run_id)
+        return run_id
+
+    def on_chain_end(self, outputs: dict, run_id: str) -> None:
+        for handler in self.handlers:
+            handler.on_chain_end(outputs, run_id=run_id)
+
+    def on_chain_error(self, error: BaseException, run_id: str) -> None:
+        for handler in self.handlers:
+            handler.on_chain_error(error, run_id=run_id)
@@ -0,0 +1,30 @@
+"""Prompt templates that format a string from input variables."""
+import re
+from typing import Dict, List
+
+
+class PromptTemplate:
+    """A prompt template is a string with {variables} that are filled at format time.
+
+    template: the template string, for example "Tell me a joke about {topic}".
+    input_variables: names of the variables the template expects.
+    """
+
+    def __init__(self, template: str, input_variables: List[str]):
+        self.template = template
+        self.input_variables = input_variables
+
+    @classmethod
+    def from_template(cls, template: str) -> "PromptTemplate":
+        """Create a PromptTemplate and infer input_variables from the braces."""
+        variables = sorted(set(re.findall(r"\{(\w+)\}", template)))
+        return cls(template=template, input_variables=variables)
+
+    def format(self, **kwargs: str) -> str:
+        missing = [name for name in self.input_variables if name not in kwargs]
+        if missing:
+            raise KeyError(f"Missing variables: {missing}")
+        return self.template.format(**kwargs)
+
+    def invoke(self, inputs: Dict[str, str]) -> str:
+        return self.format(**inputs)
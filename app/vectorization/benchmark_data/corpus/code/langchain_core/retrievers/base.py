@@ -0,0 +1,15 @@
+"""Retriever interface: return documents relevant to a query."""
+from typing import List
+
+from langchain_core.runnables.base import Runnable
+
+
+class BaseRetriever(Runnable):
+    """Abstract retriever. Subclasses implement _get_relevant_documents."""
+
+    def _get_relevant_documents(self, query: str) -> List["Document"]:
+        raise NotImplementedError
+
+    def invoke(self, input: str, config=None) -> List["Document"]:
+        """Retrieve documents for the query string."""
+        return self._get_relevant_documents(input)
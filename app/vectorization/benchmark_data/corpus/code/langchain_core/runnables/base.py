@@ -0,0 +1,54 @@
+"""Runnable protocol: the building block of LangChain Expression Language (LCEL)."""
+from typing import Any, Iterator, List, Optional
+
+
+class Runnable:
+    """A unit of work that can be invoked, batched and streamed.
+
+    Runnables are composed into pipelines with the | operator, which
+    creates a RunnableSequence.
+    """
+
+    def invoke(self, input: Any, config: Optional[dict] = None) -> Any:
+        raise NotImplementedError
+
+    def batch(self, inputs: List[Any], config: Optional[dict] = None) -> List[Any]:
+        return [self.invoke(item, config) for item in inputs]
+
+    def stream(self, input: Any, config: Optional[dict] = None) -> Iterator[Any]:
+        yield self.invoke(input, config)
+
+    def __or__(self, other: "Runnable") -> "RunnableSequence":
+        return RunnableSequence(self, other)
+
+
+class RunnableSequence(Runnable):
+    """Sequence of runnables where the output of each step is the input of the next."""
+
+    def __init__(self, *steps: Runnable):
+        self.steps = list(steps)
+
+    def invoke(self, input: Any, config: Optional[dict] = None) -> Any:
+        for step in self.steps:
+            input = step.invoke(input, config)
+        return input
+
+
+class RunnableLambda(Runnable):
+    """Wraps a Python callable as a Runnable."""
+
+    def __init__(self, func):
+        self.func = func
+
+    def invoke(self, input: Any, config: Optional[dict] = None) -> Any:
+        return self.func(input)
+
+
+class RunnableParallel(Runnable):
+    """Runs several runnables on the same input and returns a dict of outputs."""
+
+    def __init__(self, **steps: Runnable):
+        self.steps = steps
+
+    def invoke(self, input: Any, config: Optional[dict] = None) -> dict:
+        return {key: step.invoke(input, config) for key, step in self.steps.items()}
@@ -0,0 +1,50 @@
+"""Base classes for tools that an agent can call."""
+from typing import Any, Callable, Optional
+
+
+class BaseTool:
+    """Interface that every LangChain tool implements.
+
+    A tool has a name, a description that tells the model when to use it,
+    and a run method that executes the tool on the given input.
+    """
+
+    name: str
+    description: str
+    return_direct: bool = False
+
+    def __init__(self, name: str, description: str, return_direct: bool = False):
+        self.name = name
+        self.description = description
+        self.return_direct = return_direct
+
+    def _run(self, tool_input: str) -> Any:
+        raise NotImplementedError
+
+    def run(self, tool_input: str, callbacks: Optional[list] = None) -> Any:
+        """Run the tool and notify callbacks about start and end."""
+        for callback in callbacks or []:
+            callback.on_tool_start(self.name, tool_input)
+        result = self._run(tool_input)
+        for callback in callbacks or []:
+            callback.on_tool_end(result)
+        return result
+
+    def invoke(self, tool_input: str, config: Optional[dict] = None) -> Any:
+        return self.run(tool_input, callbacks=(config or {}).get("callbacks"))
+
+
+class Tool(BaseTool):
+    """Tool that wraps a plain Python function."""
+
+    def __init__(self, name: str, func: Callable[[str], Any], description: str, return_direct: bool = False):
+        super().__init__(name, description, return_direct)
+        self.func = func
+
+    def _run(self, tool_input: str) -> Any:
+        return self.func(tool_input)
+
+
+def tool(func: Callable[[str], Any]) -> Tool:
+    """Decorator that turns a function into a Tool using its docstring as description."""
+    return Tool(name=func.__name__, func=func, description=(func.__doc__ or "").strip())
@@ -0,0 +1,36 @@
+"""Vector store interface and the retriever that wraps it."""
+from typing import List, Optional
+
+from langchain_core.retrievers.base import BaseRetriever
+
+
+class VectorStore:
+    """Stores embedded documents and searches them by vector similarity."""
+
+    def add_texts(self, texts: List[str], metadatas: Optional[List[dict]] = None) -> List[str]:
+        raise NotImplementedError
+
+    def similarity_search(self, query: str, k: int = 4) -> List["Document"]:
+        raise NotImplementedError
+
+    def as_retriever(self, search_type: str = "similarity", search_kwargs: Optional[dict] = None) -> "VectorStoreRetriever":
+        """Return a VectorStoreRetriever so the vector store can be used in chains.
+
+        search_type is "similarity" or "mmr"; search_kwargs such as {"k": 4}
+        are passed to the search method.
+        """
+        return VectorStoreRetriever(vectorstore=self, search_type=search_type, search_kwargs=search_kwargs or {})
+
+
+class VectorStoreRetriever(BaseRetriever):
+    """Retriever backed by a VectorStore."""
+
+    def __init__(self, vectorstore: VectorStore, search_type: str = "similarity", search_kwargs: Optional[dict] = None):
+        self.vectorstore = vectorstore
+        self.search_type = search_type
+        self.search_kwargs = search_kwargs or {}
+
+    def _get_relevant_documents(self, query: str) -> List["Document"]:
+        if self.search_type == "mmr":
+            return self.vectorstore.max_marginal_relevance_search(query, **self.search_kwargs)
+        return self.vectorstore.similarity_search(query, **self.search_kwargs)
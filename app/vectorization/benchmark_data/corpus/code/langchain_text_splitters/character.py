@@ -0,0 +1,44 @@
+"""Text splitters that split documents into chunks by characters."""
+from typing import List
+
+
+class RecursiveCharacterTextSplitter:
+    """Split text recursively by a list of separators until chunks fit chunk_size.
+
+    chunk_size: maximum size of a chunk.
+    chunk_overlap: number of characters shared by neighbouring chunks.
+    length_function: function that measures chunk length, len by default;
+    use a tokenizer to split by tokens.
+    """
+
+    def __init__(self, chunk_size: int = 4000, chunk_overlap: int = 200, length_function=len,
+                 separators: List[str] = None):
+        if chunk_overlap > chunk_size:
+            raise ValueError("chunk_overlap must be smaller than chunk_size")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.length_function = length_function
+        self.separators = separators or ["\n\n", "\n", " ", ""]
+
+    @classmethod
+    def from_tiktoken_encoder(cls, chunk_size: int, chunk_overlap: int) -> "RecursiveCharacterTextSplitter":
+        """Splitter that measures chunk_size and chunk_overlap in tokens."""
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return cls(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                   length_function=lambda text: len(encoding.encode(text)))
+
+    def split_text(self, text: str) -> List[str]:
+        chunks, current = [], ""
+        for word in text.split(" "):
+            if self.length_function(current + " " + word) > self.chunk_size and current:
+                chunks.append(current)
+                current = current[-self.chunk_overlap:] if self.chunk_overlap else ""
+            current = (current + " " + word).strip()
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def split_documents(self, documents: list) -> list:
+        return [chunk for doc in documents for chunk in self.split_text(doc.page_content)]
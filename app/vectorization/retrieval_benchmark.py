@@ -0,0 +1,300 @@
+"""Офлайн-бенчмарк качества и скорости smart_search.
+
+Индекс строится по фикстурному корпусу из benchmark_data с детерминированными
+эмбеддингами HashingEmbeddings, поэтому для запуска не нужны сеть и GigaChat.
+По размеченным вопросам считаются recall@k и MRR на уровне файлов, доля кода
+в выдаче для каждого режима QueryAnalyzer, время построения и размер индекса,
+задержка поиска p50/p99. При сравнении с baseline процесс завершается с кодом 1,
+если качество или скорость ухудшились. Время сравнивается, только если baseline
+снят на той же машине. Дополнительно проверяется, что при разбиении Python
+файлов корпуса и фикстур из benchmark_data/chunking каждая непустая строка
+попадает в какой-то чанк.
+
+Пример:
+    python -m vectorization.retrieval_benchmark --k 6
+    python -m vectorization.retrieval_benchmark --update-baseline
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import argparse
+import platform
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from vectorization.v_a_c import INDEX_TYPES, IndexConfig, SmartCodeDocSystem, _split_python_code
+
+BENCHMARK_DATA = Path(__file__).parent / "benchmark_data"
+CORPUS_DIR = BENCHMARK_DATA / "corpus"
+QUESTIONS_PATH = BENCHMARK_DATA / "questions.json"
+BASELINE_PATH = BENCHMARK_DATA / "baseline.json"
+CHUNKING_DIR = BENCHMARK_DATA / "chunking"
+
+_WORD_RE = re.compile(r"\w+")
+_CAMEL_RE = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+
+
+class HashingEmbeddings(Embeddings):
+    """Детерминированные эмбеддинги без модели: хэширование слов в вектор фиксированной длины.
+
+    Учитываются слова, части идентификаторов (snake_case и camelCase) и
+    префиксы длинных слов, чтобы разные формы русских слов совпадали.
+    """
+
+    def __init__(self, size: int = 512):
+        self.size = size
+
+    def _features(self, text: str) -> List[str]:
+        features = []
+        for word in _WORD_RE.findall(text):
+            lowered = word.lower()
+            features.append(lowered)
+            parts = [part.lower() for piece in word.split("_") for part in _CAMEL_RE.findall(piece)]
+            if len(parts) > 1:
+                features.extend(part for part in parts if len(part) > 1)
+            if len(lowered) > 5 and lowered.isalpha():
+                features.append(lowered[:5] + "~")
+        return features
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for feature in self._features(text):
+            digest = zlib.crc32(feature.encode("utf-8"))
+            vector[digest % self.size] += 1.0 if digest & 0x80000000 else -1.0
+        vector = np.sign(vector) * np.log1p(np.abs(vector))
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm > 0 else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def load_questions(path: Path = QUESTIONS_PATH) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def directory_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names
+    )
+
+
+def uncovered_lines(paths: List[Path], chunk_size: int, chunk_overlap: int) -> Dict[str, List[int]]:
+    """Номера непустых строк Python файлов, не попавших ни в один чанк
+
+    Строка считается покрытой, только если она есть в чанке, чей диапазон
+    start_line..end_line ее включает, так что сдвиг границ тоже ловится.
+    """
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    result = {}
+    for path in paths:
+        text = path.read_text(encoding="utf-8")
+        chunks = _split_python_code(text, splitter, chunk_size)
+        missing = [
+            number for number, line in enumerate(io.StringIO(text, newline=None).readlines(), 1)
+            if line.strip() and not any(
+                line.strip() in chunk
+                and symbol.get("start_line", number) <= number <= symbol.get("end_line", number)
+                for chunk, symbol in chunks
+            )
+        ]
+        if missing:
+            result[str(path.relative_to(BENCHMARK_DATA))] = missing
+    return result
+
+
+def evaluate_question(result, relevant: List[str]) -> dict:
+    """recall@k и reciprocal rank по файлам, доля кода в выдаче"""
+    files = [f"{doc.metadata.get('type')}:{doc.metadata.get('relative_path')}" for doc in result.documents]
+    found = set(files) & set(relevant)
+    first_rank = next((rank for rank, key in enumerate(files, 1) if key in relevant), None)
+    code = sum(1 for doc in result.documents if doc.metadata.get("type") == "code")
+    return {
+        "recall_at_k": len(found) / len(relevant) if relevant else 1.0,
+        "reciprocal_rank": 1.0 / first_rank if first_rank else 0.0,
+        "code_share": code / len(result.documents) if result.documents else 0.0,
+    }
+
+
+def run_benchmark(k: int = 6, repeats: int = 5, index_type: str = "flat", chunk_size: int = 600,
+                  chunk_overlap: int = 100, questions_path: Path = QUESTIONS_PATH) -> dict:
+    questions = load_questions(questions_path)
+    embeddings = HashingEmbeddings()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store_path = os.path.join(tmp, "vector_store")
+        builder = SmartCodeDocSystem(embeddings, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                     index_config=IndexConfig(index_type=index_type))
+        start = time.perf_counter()
+        builder.build_vector_store(CORPUS_DIR / "code", CORPUS_DIR / "docs", store_path, ingest_workers=1)
+        build_s = time.perf_counter() - start
+        index_bytes = directory_size(store_path)
+
+        system = SmartCodeDocSystem(embeddings, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                    index_config=IndexConfig(index_type=index_type))
+        start = time.perf_counter()
+        system.load_vector_store(store_path)
+        load_s = time.perf_counter() - start
+        chunks = {doc_type: len(store.index_to_docstore_id) for doc_type, store in system.vector_stores.items()}
+
+        rows = []
+        latencies = []
+        stage_totals: Dict[str, float] = {}
+        for item in questions:
+            for _ in range(repeats):
+                start = time.perf_counter()
+                result = system.smart_search(item["question"], k=k)
+                latencies.append((time.perf_counter() - start) * 1000)
+                for stage, ms in result.timings.items():
+                    stage_totals[stage] = stage_totals.get(stage, 0.0) + ms
+            row = {"question": item["question"], "mode": result.search_type}
+            row.update(evaluate_question(result, item["relevant"]))
+            rows.append(row)
+
+    modes = {}
+    for mode in sorted({row["mode"] for row in rows}):
+        mode_rows = [row for row in rows if row["mode"] == mode]
+        modes[mode] = {
+            "questions": len(mode_rows),
+            "recall_at_k": float(np.mean([row["recall_at_k"] for row in mode_rows])),
+            "mrr": float(np.mean([row["reciprocal_rank"] for row in mode_rows])),
+            "code_share": float(np.mean([row["code_share"] for row in mode_rows])),
+        }
+
+    searches = len(questions) * repeats
+    return {
+        "host": platform.node(),
+        "config": {"k": k, "index_type": index_type, "embedding_size": embeddings.size,
+                   "chunk_size": chunk_size, "chunk_overlap": chunk_overlap},
+        "repeats": repeats,
+        "build_s": build_s,
+        "load_s": load_s,
+        "index_bytes": index_bytes,
+        "chunks": chunks,
+        "recall_at_k": float(np.mean([row["recall_at_k"] for row in rows])),
+        "mrr": float(np.mean([row["reciprocal_rank"] for row in rows])),
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+        "stage_ms": {stage: total / searches for stage, total in stage_totals.items()},
+        "modes": modes,
+        "questions": rows,
+        "uncovered_lines": uncovered_lines(
+            sorted((CORPUS_DIR / "code").rglob("*.py")) + sorted(CHUNKING_DIR.glob("*.py")),
+            chunk_size, chunk_overlap
+        ),
+    }
+
+
+def check_regressions(report: dict, baseline: dict, quality_tolerance: float = 0.02,
+                      latency_tolerance: float = 1.5, size_tolerance: float = 1.1) -> List[str]:
+    """Сравнивает отчет с baseline и возвращает описания регрессий"""
+    problems = [
+        f"строки {path} не попали в чанки: {', '.join(map(str, lines))}"
+        for path, lines in report.get("uncovered_lines", {}).items()
+    ]
+    if report["config"] != baseline.get("config"):
+        problems.append(f"конфигурация отличается от baseline: {baseline.get('config')}")
+        return problems
+
+    for metric in ("recall_at_k", "mrr"):
+        if report[metric] < baseline[metric] - quality_tolerance:
+            problems.append(f"{metric}: {report[metric]:.3f} < {baseline[metric]:.3f}")
+    for mode, stats in baseline.get("modes", {}).items():
+        current = report["modes"].get(mode)
+        if current is None:
+            problems.append(f"режим {mode}: нет вопросов, в baseline было {stats['questions']}")
+        elif current["recall_at_k"] < stats["recall_at_k"] - quality_tolerance:
+            problems.append(f"recall_at_k в режиме {mode}: {current['recall_at_k']:.3f} < {stats['recall_at_k']:.3f}")
+
+    if report["index_bytes"] > baseline["index_bytes"] * size_tolerance:
+        problems.append(f"размер индекса: {report['index_bytes']} > {baseline['index_bytes']} байт")
+
+    if report["host"] == baseline.get("host"):
+        # Небольшой абсолютный запас, чтобы доли миллисекунды не давали ложных срабатываний
+        for metric, slack in (("latency_p50_ms", 1.0), ("latency_p99_ms", 2.0), ("build_s", 0.5)):
+            if report[metric] > baseline[metric] * latency_tolerance + slack:
+                problems.append(f"{metric}: {report[metric]:.3f} > {baseline[metric]:.3f}")
+    else:
+        print("baseline снят на другой машине, время не сравнивается")
+    return problems
+
+
+def print_report(report: dict):
+    config = report["config"]
+    print(f"\nИндекс {config['index_type']}, k={config['k']}, чанков: {report['chunks']}")
+    print(f"Построение: {report['build_s']:.2f} с, загрузка: {report['load_s']:.3f} с, "
+          f"размер: {report['index_bytes'] / 2 ** 10:.1f} КБ")
+    print(f"recall@{config['k']}: {report['recall_at_k']:.3f}, MRR: {report['mrr']:.3f}")
+    print(f"Задержка smart_search: p50 {report['latency_p50_ms']:.2f} мс, p99 {report['latency_p99_ms']:.2f} мс")
+    print("Этапы, мс: " + ", ".join(f"{stage} {ms:.2f}" for stage, ms in report["stage_ms"].items()))
+
+    print(f"\n{'режим':<12} {'вопросов':>8} {'recall':>7} {'MRR':>6} {'доля кода':>10}")
+    for mode, stats in report["modes"].items():
+        print(f"{mode:<12} {stats['questions']:>8} {stats['recall_at_k']:>7.3f} {stats['mrr']:>6.3f} {stats['code_share']:>10.2f}")
+
+    misses = [row for row in report["questions"] if row["recall_at_k"] < 1.0]
+    if misses:
+        print("\nНе все релевантные файлы найдены:")
+        for row in misses:
+            print(f"  [{row['mode']}] recall {row['recall_at_k']:.2f}: {row['question']}")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк smart_search на фикстурном корпусе")
+    parser.add_argument("--k", type=int, default=6)
+    parser.add_argument("--repeats", type=int, default=5, help="Повторов каждого запроса для замера задержки")
+    parser.add_argument("--index-type", default="flat", choices=INDEX_TYPES)
+    parser.add_argument("--questions", default=str(QUESTIONS_PATH), help="Файл с размеченными вопросами")
+    parser.add_argument("--baseline", default=str(BASELINE_PATH), help="Файл baseline для сравнения")
+    parser.add_argument("--update-baseline", action="store_true", help="Сохранить результат как новый baseline")
+    parser.add_argument("--quality-tolerance", type=float, default=0.02)
+    parser.add_argument("--latency-tolerance", type=float, default=1.5)
+    parser.add_argument("--output", help="Сохранить отчет в JSON")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(k=args.k, repeats=args.repeats, index_type=args.index_type,
+                           questions_path=Path(args.questions))
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nОтчет сохранен в {args.output}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nBaseline обновлен: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nBaseline {args.baseline} не найден, сравнение пропущено")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    problems = check_regressions(report, baseline, args.quality_tolerance, args.latency_tolerance)
+    if problems:
+        print("\nРегрессии относительно baseline:")
+        for problem in problems:
+            print(f"  - {problem}")
+        return 1
+    print("\nРегрессий относительно baseline нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,24 +1,80 @@
+import io
 import os
 import re
+import ast
+import math
+import heapq
+import asyncio
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import uuid
+import threading
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List
-from dataclasses import dataclass
-import streamlit as st
+from typing import List, Optional, Tuple, Dict, Iterable, Iterator, Sequence, Union
+from dataclasses import dataclass, field
+import numpy as np
+from langchain.docstore.base import AddableMixin, Docstore
 from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.vectorstores import FAISS
 from langchain.schema import BaseRetriever
 from langchain.prompts import ChatPromptTemplate
+from langchain.schema.runnable import Runnable, RunnableLambda, RunnablePassthrough
 from pydantic import Field
 
 
+def _estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (около 4 символов на токен)"""
+    return max(1, len(text) // 4)
+
+
+def _distance_to_similarity(distance: float) -> float:
+    """Переводит квадрат L2-расстояния FAISS в косинусную близость (для нормированных эмбеддингов)"""
+    return max(0.0, 1.0 - float(distance) / 2.0)
+
+
+def _elapsed_ms(start: float) -> float:
+    return (time.perf_counter() - start) * 1000
+
+
+def _chunk_id(metadata: dict) -> str:
+    """Стабильный идентификатор чанка в векторном хранилище"""
+    return f"{metadata['type']}:{metadata['relative_path']}#{metadata['chunk_index']}"
+
+
+def _file_key(doc_type: str, relative_path: str) -> str:
+    return f"{doc_type}:{relative_path}"
+
+
+CONTENT_TYPES = ("code", "doc")
+
+DEFAULT_CODE_GLOBS = ("*.py",)
+DEFAULT_DOC_GLOBS = ("*.md",)
+
+
 @dataclass
 class SearchResult:
-    """Результат умного поиска"""
+    """Результат умного поиска.
+
+    timings — длительность этапов в миллисекундах, counters — счетчики запроса
+    (кандидаты, дубликаты, попадания в кэш, токены). code_ratio — доля кода,
+    выбранная CentroidRouter, или None, если тип поиска определил QueryAnalyzer.
+    """
     documents: List[Document]
     search_type: str
     primary_chunks: List[Document]
     related_chunks: List[Document]
+    scores: List[float] = field(default_factory=list)
+    timings: Dict[str, float] = field(default_factory=dict)
+    counters: Dict[str, int] = field(default_factory=dict)
+    code_ratio: Optional[float] = None
 
 
 class QueryAnalyzer:
@@ -62,89 +118,881 @@ class QueryAnalyzer:
             return "balanced"
 
 
+class CentroidRouter:
+    """Определяет долю кода в выдаче по эмбеддингу запроса.
+
+    Направление — разность нормированных центроидов векторов кода и
+    документации. Проекция запроса на него переводится в долю кода в [0, 1]
+    логистической функцией, откалиброванной по средним проекциям самих чанков:
+    средний чанк кода получает ~0.88, средний чанк документации — ~0.12.
+    """
+
+    def __init__(self, direction: np.ndarray, bias: float, scale: float, balanced_margin: float = 0.15):
+        self.direction = np.asarray(direction, dtype=np.float32)
+        self.bias = float(bias)
+        self.scale = float(scale)
+        self.balanced_margin = balanced_margin
+
+    @classmethod
+    def from_stores(cls, vector_stores: Dict[str, "FAISS"], sample_size: int = 50000,
+                    seed: int = 0) -> Optional["CentroidRouter"]:
+        """Строит маршрутизатор по векторам разделов code и doc (не больше sample_size из каждого)"""
+        if any(vector_stores.get(doc_type) is None or not vector_stores[doc_type].index.ntotal
+               for doc_type in CONTENT_TYPES):
+            return None
+        
+        rng = np.random.default_rng(seed)
+        samples = {}
+        for doc_type in CONTENT_TYPES:
+            index = vector_stores[doc_type].index
+            n = index.ntotal
+            positions = np.arange(n) if n <= sample_size else np.sort(rng.choice(n, size=sample_size, replace=False))
+            vectors = index.reconstruct_batch(positions.astype(np.int64))
+            samples[doc_type] = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        
+        centroids = {doc_type: vectors.mean(axis=0) for doc_type, vectors in samples.items()}
+        centroids = {doc_type: c / max(np.linalg.norm(c), 1e-12) for doc_type, c in centroids.items()}
+        direction = centroids["code"] - centroids["doc"]
+        code_mean = float((samples["code"] @ direction).mean())
+        doc_mean = float((samples["doc"] @ direction).mean())
+        return cls(direction, (code_mean + doc_mean) / 2, max((code_mean - doc_mean) / 2, 1e-6))
+
+    def code_ratio(self, query_vector: Sequence[float]) -> Optional[float]:
+        query = np.asarray(query_vector, dtype=np.float32)
+        if query.shape != self.direction.shape:
+            return None
+        projection = float(query @ self.direction) / max(float(np.linalg.norm(query)), 1e-12)
+        return 1.0 / (1.0 + math.exp(-2.0 * (projection - self.bias) / self.scale))
+
+    def search_type(self, code_ratio: float) -> str:
+        if code_ratio >= 0.5 + self.balanced_margin:
+            return "code-first"
+        if code_ratio <= 0.5 - self.balanced_margin:
+            return "doc-first"
+        return "balanced"
+
+    @staticmethod
+    def quotas(code_ratio: float, k: int) -> Dict[str, int]:
+        """Делит k мест между разделами пропорционально доле кода, оставляя каждому хотя бы одно"""
+        code = int(round(k * code_ratio))
+        if k >= 2:
+            code = min(max(code, 1), k - 1)
+        return {"code": code, "doc": k - code}
+
+    def save(self, path: str):
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, direction=self.direction, bias=self.bias, scale=self.scale)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "CentroidRouter":
+        with np.load(path) as data:
+            return cls(data["direction"], float(data["bias"]), float(data["scale"]))
+
+
+class CachedEmbeddings(Embeddings):
+    """Кэширующая обертка над моделью эмбеддингов.
+
+    Держит LRU-кэш в памяти и, опционально, SQLite-хранилище на диске,
+    поэтому повторные запросы не ходят в удаленный API. Хранилище на диске
+    ограничено max_disk_entries (вытесняются самые старые записи).
+    Эмбеддинги документов кэшируются только при cache_documents=True, чтобы
+    построение индекса не вытесняло запросы и не раздувало хранилище.
+    """
+
+    def __init__(self, embeddings, max_size: int = 10000, ttl: Optional[float] = None,
+                 db_path: Optional[str] = None, max_disk_entries: Optional[int] = 100000,
+                 cache_documents: bool = False):
+        self.embeddings = embeddings
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_path = db_path
+        self.max_disk_entries = max_disk_entries
+        self.cache_documents = cache_documents
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, Tuple[float, List[float]]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._model_id = str(getattr(embeddings, "model", None) or type(embeddings).__name__)
+        self._db = None
+
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, created REAL NOT NULL, vector BLOB NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_created ON embeddings (created)")
+            self._db.commit()
+            self.purge_expired()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Нормализует текст запроса перед хэшированием"""
+        return " ".join(text.split())
+
+    def _key(self, namespace: str, text: str) -> str:
+        raw = f"{self._model_id}:{namespace}:{self.normalize(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, vector = entry
+                if not self._expired(created):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return vector
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT created, vector FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    created, blob = row
+                    if not self._expired(created):
+                        vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                        self._remember(key, created, vector)
+                        self.hits += 1
+                        return vector
+                    self._db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def _remember(self, key: str, created: float, vector: List[float]):
+        self._memory[key] = (created, vector)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _put(self, key: str, vector: List[float]):
+        self._put_many([(key, vector)])
+
+    def _put_many(self, items: List[Tuple[str, List[float]]]):
+        """Сохраняет векторы в памяти и на диске одной транзакцией"""
+        created = time.time()
+        with self._lock:
+            for key, vector in items:
+                self._remember(key, created, vector)
+            if self._db is not None:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, created, vector) VALUES (?, ?, ?)",
+                    [(key, created, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items]
+                )
+                if self.max_disk_entries is not None:
+                    self._db.execute(
+                        "DELETE FROM embeddings WHERE key IN "
+                        "(SELECT key FROM embeddings ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                        (self.max_disk_entries,)
+                    )
+                self._db.commit()
+
+    def _lookup_many(self, namespace: str, texts: List[str]) -> Tuple[List[Optional[List[float]]], Dict[str, List[int]]]:
+        """Возвращает найденные векторы и позиции промахов, сгруппированные по ключу"""
+        vectors: List[Optional[List[float]]] = []
+        missing: Dict[str, List[int]] = {}
+        for i, text in enumerate(texts):
+            key = self._key(namespace, text)
+            if key in missing:
+                missing[key].append(i)
+                vectors.append(None)
+                continue
+            vector = self._get(key)
+            if vector is None:
+                missing[key] = [i]
+            vectors.append(vector)
+        return vectors, missing
+
+    def _fill_missing(self, vectors, missing: Dict[str, List[int]], computed: List[List[float]]):
+        self._put_many(list(zip(missing, computed)))
+        for positions, vector in zip(missing.values(), computed):
+            for i in positions:
+                vectors[i] = vector
+        return vectors
+
+    def embed_query_with_hit(self, text: str) -> Tuple[List[float], bool]:
+        """Как embed_query, но также сообщает, взят ли вектор из кэша"""
+        key = self._key("query", text)
+        vector = self._get(key)
+        if vector is not None:
+            return vector, True
+        vector = self.embeddings.embed_query(text)
+        self._put(key, vector)
+        return vector, False
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_query_with_hit(text)[0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not self.cache_documents:
+            return self.embeddings.embed_documents(texts)
+        vectors, missing = self._lookup_many("document", texts)
+        if missing:
+            first_texts = [texts[positions[0]] for positions in missing.values()]
+            computed = self.embeddings.embed_documents(first_texts)
+            self._fill_missing(vectors, missing, computed)
+        return vectors
+
+    def embed_queries_with_hits(self, texts: List[str]) -> Tuple[List[List[float]], List[bool]]:
+        """Векторизует несколько запросов, обращаясь к модели только за промахами
+        кэша (по разу на уникальный текст); для каждого запроса сообщает, взят ли
+        вектор из кэша.
+
+        Промахи считаются через embed_query: у моделей с разными режимами для
+        запросов и документов embed_documents дал бы другие векторы.
+        """
+        vectors, missing = self._lookup_many("query", texts)
+        missed = {i for positions in missing.values() for i in positions}
+        if missing:
+            computed = [self.embeddings.embed_query(texts[positions[0]]) for positions in missing.values()]
+            self._fill_missing(vectors, missing, computed)
+        return vectors, [i not in missed for i in range(len(texts))]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_queries_with_hits(texts)[0]
+
+    async def aembed_query_with_hit(self, text: str) -> Tuple[List[float], bool]:
+        key = self._key("query", text)
+        vector = self._get(key)
+        if vector is not None:
+            return vector, True
+        vector = await self.embeddings.aembed_query(text)
+        self._put(key, vector)
+        return vector, False
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_query_with_hit(text))[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not self.cache_documents:
+            return await self.embeddings.aembed_documents(texts)
+        vectors, missing = self._lookup_many("document", texts)
+        if missing:
+            first_texts = [texts[positions[0]] for positions in missing.values()]
+            computed = await self.embeddings.aembed_documents(first_texts)
+            self._fill_missing(vectors, missing, computed)
+        return vectors
+
+    def purge_expired(self) -> int:
+        """Удаляет устаревшие записи с диска, возвращает их количество"""
+        if self._db is None or self.ttl is None:
+            return 0
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM embeddings WHERE created < ?", (time.time() - self.ttl,)
+            )
+            self._db.commit()
+            return cursor.rowcount
+
+    def clear(self):
+        """Очищает кэш в памяти и на диске"""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
+
+    def cache_info(self) -> Dict[str, int]:
+        """Статистика кэша: попадания, промахи и размер в памяти"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._memory)}
+
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq", "sq8")
+
+
+@dataclass
+class IndexConfig:
+    """Параметры FAISS индекса.
+
+    index_type: flat (точный поиск), ivf_flat, hnsw, ivf_pq или sq8.
+    nprobe и ef_search задают точность поиска для IVF и HNSW соответственно.
+    """
+    index_type: str = "flat"
+    nlist: int = 1024
+    nprobe: int = 16
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    ef_search: int = 64
+    pq_m: int = 64
+    pq_bits: int = 8
+    train_size: int = 50000
+
+    def __post_init__(self):
+        if self.index_type not in INDEX_TYPES:
+            raise ValueError(f"Неизвестный тип индекса {self.index_type}, допустимы: {', '.join(INDEX_TYPES)}")
+
+
+def _index_factory_string(config: IndexConfig, dim: int, n_train: int) -> str:
+    """Строка index_factory с поправкой параметров на размер обучающей выборки"""
+    nlist = max(1, min(config.nlist, n_train // 39))
+    if config.index_type == "ivf_flat":
+        return f"IVF{nlist},Flat"
+    if config.index_type == "hnsw":
+        return f"HNSW{config.hnsw_m},Flat"
+    if config.index_type == "ivf_pq":
+        pq_m = max(m for m in range(1, min(config.pq_m, dim) + 1) if dim % m == 0)
+        return f"IVF{nlist},PQ{pq_m}x{config.pq_bits}"
+    if config.index_type == "sq8":
+        return "SQ8"
+    return "Flat"
+
+
+def apply_search_params(index, config: IndexConfig):
+    """Выставляет nprobe / efSearch для IVF и HNSW индексов"""
+    import faiss
+    
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = config.nprobe
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        hnsw.efSearch = config.ef_search
+
+
+def build_faiss_index(vectors: np.ndarray, config: IndexConfig, seed: int = 0):
+    """Создает индекс заданного типа, обучает его на случайной выборке и добавляет векторы.
+
+    Если векторов слишком мало для обучения, возвращается точный Flat индекс.
+    """
+    import faiss
+    
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, dim = vectors.shape
+    # Минимум, без которого FAISS не обучит индекс: по вектору на центроид IVF
+    # (nlist подстраивается под n // 39) и на каждый код PQ. Рекомендуемые FAISS
+    # 39 векторов на центроид PQ — лишь условие хорошей точности.
+    min_train = {"ivf_flat": 39, "ivf_pq": max(39, 2 ** config.pq_bits)}.get(config.index_type, 1)
+    if config.index_type == "flat" or n < min_train:
+        if config.index_type != "flat":
+            print(f"Недостаточно векторов ({n}) для {config.index_type}, используется flat")
+        index = faiss.IndexFlatL2(dim)
+        index.add(vectors)
+        return index
+    
+    index = faiss.index_factory(dim, _index_factory_string(config, dim, min(n, config.train_size)))
+    if config.index_type == "hnsw":
+        faiss.downcast_index(index).hnsw.efConstruction = config.ef_construction
+    if not index.is_trained:
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, size=min(n, config.train_size), replace=False)]
+        index.train(sample)
+    
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.set_direct_map_type(faiss.DirectMap.Array)
+    index.add(vectors)
+    apply_search_params(index, config)
+    return index
+
+
+def ivf_keep_positions(index, keep: Sequence[int]):
+    """Копия обученного IVF индекса только с векторами на позициях keep.
+
+    Векторы перенумеровываются подряд в порядке keep. Коды переносятся из
+    инвертированных списков как есть, без переобучения и повторного
+    кодирования, поэтому у ivf_pq ошибка квантования не накапливается от
+    удаления к удалению.
+    """
+    import faiss
+    
+    ivf = faiss.extract_index_ivf(index)
+    result = faiss.clone_index(index)
+    result.reset()
+    result_ivf = faiss.extract_index_ivf(result)
+    
+    new_ids = np.full(index.ntotal, -1, dtype=np.int64)
+    new_ids[np.asarray(keep, dtype=np.int64)] = np.arange(len(keep), dtype=np.int64)
+    invlists = ivf.invlists
+    code_size = invlists.code_size
+    for list_no in range(ivf.nlist):
+        size = invlists.list_size(list_no)
+        if size == 0:
+            continue
+        ids = faiss.rev_swig_ptr(invlists.get_ids(list_no), size).copy()
+        codes = faiss.rev_swig_ptr(invlists.get_codes(list_no), size * code_size).copy().reshape(size, code_size)
+        mapped = new_ids[ids]
+        mask = mapped >= 0
+        if mask.any():
+            kept_ids = np.ascontiguousarray(mapped[mask])
+            kept_codes = np.ascontiguousarray(codes[mask])
+            result_ivf.invlists.add_entries(list_no, len(kept_ids), faiss.swig_ptr(kept_ids), faiss.swig_ptr(kept_codes))
+    
+    result_ivf.ntotal = len(keep)
+    result.ntotal = len(keep)
+    # Прямое отображение строится заново по новым идентификаторам
+    result_ivf.set_direct_map_type(faiss.DirectMap.NoMap)
+    result_ivf.set_direct_map_type(faiss.DirectMap.Array)
+    return result
+
+
+_COLUMNAR_FIELDS = ("type", "relative_path", "chunk_index", "content_summary")
+
+
+class ColumnarDocstore(Docstore, AddableMixin):
+    """Хранилище чанков в Arrow IPC файле без pickle.
+
+    Файл отображается в память, поэтому процессы-воркеры разделяют одни и те же
+    страницы, а Document создается только при обращении к чанку. Добавления и
+    удаления после загрузки держатся в памяти до следующего сохранения.
+    Хранилище, которое будет перезаписано, открывается с mmap=False: таблица
+    читается в память, и файл можно заменить (на Windows отображенный в память
+    файл заменить нельзя).
+    """
+
+    def __init__(self, table=None):
+        self._table = table
+        self._row_ids: List[str] = [] if table is None else table.column("id").to_pylist()
+        self._rows = {doc_id: row for row, doc_id in enumerate(self._row_ids)}
+        self._added: Dict[str, Document] = {}
+        self._deleted: set = set()
+
+    @classmethod
+    def open(cls, path: str, mmap: bool = True) -> "ColumnarDocstore":
+        import pyarrow as pa
+        
+        if mmap:
+            return cls(pa.ipc.open_file(pa.memory_map(path, "r")).read_all())
+        with pa.OSFile(path, "rb") as source:
+            return cls(pa.ipc.open_file(source).read_all())
+
+    @property
+    def row_ids(self) -> List[str]:
+        """Идентификаторы в порядке строк файла (совпадает с позициями в индексе FAISS)"""
+        return self._row_ids
+
+    def _exists(self, doc_id: str) -> bool:
+        return doc_id in self._added or (doc_id in self._rows and doc_id not in self._deleted)
+
+    def _document(self, row: int) -> Document:
+        table = self._table
+        metadata = json.loads(table.column("extra")[row].as_py() or "{}")
+        for name in _COLUMNAR_FIELDS:
+            value = table.column(name)[row].as_py()
+            if value is not None:
+                metadata[name] = value
+        return Document(
+            id=self._row_ids[row],
+            page_content=table.column("page_content")[row].as_py(),
+            metadata=metadata
+        )
+
+    def search(self, search: str) -> Union[str, Document]:
+        if search in self._added:
+            return self._added[search]
+        row = self._rows.get(search)
+        if row is None or search in self._deleted:
+            return f"ID {search} not found."
+        return self._document(row)
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        overlapping = [doc_id for doc_id in texts if self._exists(doc_id)]
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        self._added.update(texts)
+
+    def delete(self, ids: List) -> None:
+        missing = [doc_id for doc_id in ids if not self._exists(doc_id)]
+        if missing:
+            raise ValueError(f"Tried to delete ids that does not exist: {missing}")
+        for doc_id in ids:
+            if self._added.pop(doc_id, None) is None:
+                self._deleted.add(doc_id)
+
+    @staticmethod
+    def write(path: str, documents: List[Document]):
+        """Записывает чанки в Arrow IPC файл (без сжатия, чтобы его можно было отображать в память)"""
+        import pyarrow as pa
+        
+        columns = {name: [] for name in ("id", "page_content", *_COLUMNAR_FIELDS, "extra")}
+        for doc in documents:
+            metadata = dict(doc.metadata)
+            columns["id"].append(doc.id)
+            columns["page_content"].append(doc.page_content)
+            for name in _COLUMNAR_FIELDS:
+                columns[name].append(metadata.pop(name, None))
+            columns["extra"].append(json.dumps(metadata, ensure_ascii=False) if metadata else None)
+        
+        schema = pa.schema([
+            ("id", pa.string()),
+            ("page_content", pa.large_string()),
+            ("type", pa.string()),
+            ("relative_path", pa.string()),
+            ("chunk_index", pa.int64()),
+            ("content_summary", pa.string()),
+            ("extra", pa.string()),
+        ])
+        table = pa.Table.from_pydict(columns, schema=schema)
+        tmp_path = path + ".tmp"
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+
+
+class ChunkStore(Sequence):
+    """Компактное хранилище чанков корпуса в памяти.
+
+    Тексты и краткие описания лежат в общих UTF-8 буферах с массивами смещений,
+    тип хранится кодом из CONTENT_TYPES, относительные пути интернированы,
+    остальные метаданные упакованы в JSON. Document создается только при
+    обращении к элементу, поэтому накладные расходы на чанк — несколько чисел
+    вместо объекта с отдельным словарем метаданных.
+    """
+
+    def __init__(self, documents: Iterable[Document] = ()):
+        self._types = array("b")
+        self._paths: List[str] = []
+        self._path_codes: Dict[str, int] = {}
+        self._path_ids = array("I")
+        self._chunk_indexes = array("q")
+        self._text = bytearray()
+        self._text_offsets = array("Q", [0])
+        self._summaries = bytearray()
+        self._summary_offsets = array("Q", [0])
+        self._extra = bytearray()
+        self._extra_offsets = array("Q", [0])
+        self._ids: Dict[int, str] = {}
+        self.extend(documents)
+
+    def append(self, doc: Document):
+        metadata = dict(doc.metadata)
+        doc_type = metadata.pop("type")
+        if doc_type not in CONTENT_TYPES:
+            raise ValueError(f"Неизвестный тип чанка: {doc_type}")
+        path = metadata.pop("relative_path")
+        path_id = self._path_codes.get(path)
+        if path_id is None:
+            path_id = self._path_codes[path] = len(self._paths)
+            self._paths.append(path)
+
+        if doc.id is not None:
+            self._ids[len(self)] = doc.id
+        self._types.append(CONTENT_TYPES.index(doc_type))
+        self._path_ids.append(path_id)
+        self._chunk_indexes.append(metadata.pop("chunk_index"))
+        self._text += doc.page_content.encode("utf-8")
+        self._text_offsets.append(len(self._text))
+        self._summaries += metadata.pop("content_summary", "").encode("utf-8")
+        self._summary_offsets.append(len(self._summaries))
+        if metadata:
+            self._extra += json.dumps(metadata, ensure_ascii=False).encode("utf-8")
+        self._extra_offsets.append(len(self._extra))
+
+    def extend(self, documents: Iterable[Document]):
+        for doc in documents:
+            self.append(doc)
+
+    def __len__(self) -> int:
+        return len(self._types)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._document(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("индекс чанка вне диапазона")
+        return self._document(i)
+
+    def __iter__(self) -> Iterator[Document]:
+        for i in range(len(self)):
+            yield self._document(i)
+
+    def _document(self, i: int) -> Document:
+        extra = bytes(self._extra[self._extra_offsets[i]:self._extra_offsets[i + 1]])
+        metadata = json.loads(extra) if extra else {}
+        metadata.update({
+            "chunk_index": self._chunk_indexes[i],
+            "type": CONTENT_TYPES[self._types[i]],
+            "relative_path": self._paths[self._path_ids[i]],
+            "content_summary": self._summaries[self._summary_offsets[i]:self._summary_offsets[i + 1]].decode("utf-8"),
+        })
+        return Document(
+            id=self._ids.get(i),
+            page_content=self._text[self._text_offsets[i]:self._text_offsets[i + 1]].decode("utf-8"),
+            metadata=metadata
+        )
+
+    def iter_batches(self, batch_size: int) -> Iterator[List[Document]]:
+        """Отдает чанки батчами Document, не материализуя весь корпус"""
+        for start in range(0, len(self), batch_size):
+            yield self[start:start + batch_size]
+
+    def count_by_type(self) -> Dict[str, int]:
+        counts = Counter(self._types)
+        return {doc_type: counts.get(code, 0) for code, doc_type in enumerate(CONTENT_TYPES)}
+
+    def nbytes(self) -> int:
+        """Размер буферов и массивов в байтах (без интернированных путей)"""
+        arrays = (self._types, self._path_ids, self._chunk_indexes,
+                  self._text_offsets, self._summary_offsets, self._extra_offsets)
+        return (len(self._text) + len(self._summaries) + len(self._extra)
+                + sum(a.itemsize * len(a) for a in arrays))
+
+
+_IDENTIFIER_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|[^\W\d_]+")
+_IDENTIFIER_PART_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def _tokenize_identifiers(text: str) -> List[str]:
+    """Токенизация с учетом идентификаторов кода.
+
+    Идентификатор попадает в токены целиком и по частям:
+    TextLoader -> textloader, text, loader; invoke_run -> invoke_run, invoke, run.
+    """
+    tokens = []
+    for word in _IDENTIFIER_RE.findall(text):
+        token = word.lower()
+        if len(token) < 2:
+            continue
+        tokens.append(token)
+        parts = [part.lower() for piece in word.split("_") for part in _IDENTIFIER_PART_RE.findall(piece)]
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if len(part) > 1)
+    return tokens
+
+
+class LexicalIndex:
+    """Инвертированный индекс BM25 по идентификаторам кода и словам текста"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids: List[str] = []
+        self.types: List[str] = []
+        self.lengths: List[int] = []
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self._positions: Dict[str, int] = {}
+        self._deleted: set = set()
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.ids) - len(self._deleted)
+
+    def add(self, doc_id: str, doc_type: str, text: str):
+        if doc_id in self._positions:
+            self.delete([doc_id])
+        
+        position = len(self.ids)
+        tokens = _tokenize_identifiers(text)
+        self.ids.append(doc_id)
+        self.types.append(doc_type)
+        self.lengths.append(len(tokens))
+        self._positions[doc_id] = position
+        self._total_length += len(tokens)
+        for term, tf in Counter(tokens).items():
+            self.postings.setdefault(term, {})[position] = tf
+
+    def delete(self, doc_ids: Iterable[str]):
+        for doc_id in doc_ids:
+            position = self._positions.pop(doc_id, None)
+            if position is not None:
+                self._deleted.add(position)
+                self._total_length -= self.lengths[position]
+
+    def search(self, query: str, k: int = 10, doc_type: Optional[str] = None) -> List[Tuple[str, float]]:
+        """Возвращает до k пар (id чанка, BM25) по убыванию релевантности"""
+        live = len(self)
+        if live == 0:
+            return []
+        
+        avg_length = max(self._total_length / live, 1.0)
+        scores: Dict[int, float] = {}
+        for term in set(_tokenize_identifiers(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            # Удаленные позиции остаются в postings до сохранения и не должны влиять на df
+            if self._deleted:
+                postings = {position: tf for position, tf in postings.items() if position not in self._deleted}
+            df = len(postings)
+            if not df or df > live / 2:
+                continue
+            idf = math.log(1 + (live - df + 0.5) / (df + 0.5))
+            for position, tf in postings.items():
+                if doc_type is not None and self.types[position] != doc_type:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[position] / avg_length)
+                scores[position] = scores.get(position, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(self.ids[position], score) for position, score in top]
+
+    def save(self, path: str):
+        """Сохраняет индекс в JSON, отбрасывая удаленные чанки"""
+        remap = {}
+        ids, types, lengths = [], [], []
+        for position, doc_id in enumerate(self.ids):
+            if position in self._deleted:
+                continue
+            remap[position] = len(ids)
+            ids.append(doc_id)
+            types.append(self.types[position])
+            lengths.append(self.lengths[position])
+        
+        postings = {}
+        for term, term_postings in self.postings.items():
+            live_postings = [[remap[p], tf] for p, tf in term_postings.items() if p in remap]
+            if live_postings:
+                postings[term] = live_postings
+        
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"ids": ids, "types": types, "lengths": lengths, "postings": postings}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls()
+        index.ids = data["ids"]
+        index.types = data["types"]
+        index.lengths = data["lengths"]
+        index.postings = {term: {p: tf for p, tf in postings} for term, postings in data["postings"].items()}
+        index._positions = {doc_id: position for position, doc_id in enumerate(index.ids)}
+        index._total_length = sum(index.lengths)
+        return index
+
+
 class SmartCodeDocSystem:
-    """Полная система для работы с кодом и документацией"""
+    """Полная система для работы с кодом и документацией.
+
+    search_workers — размер пула для параллельного поиска по разделам одного
+    запроса. По умолчанию разделы ищутся в потоке вызывающего, чтобы число
+    одновременных запросов (например, в многопоточном сервере) ничем не
+    ограничивалось; пул имеет смысл при одном вызывающем.
+    """
     
-    def __init__(self, embeddings, chunk_size: int = 1000, chunk_overlap: int = 200):
+    def __init__(self, embeddings, chunk_size: int = 1000, chunk_overlap: int = 200,
+                 index_config: Optional[IndexConfig] = None, search_workers: Optional[int] = None):
         self.embeddings = embeddings
+        self.index_config = index_config or IndexConfig()
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap
         )
         self.query_analyzer = QueryAnalyzer()
-        self.vector_store = None
-        self.documents = []
+        self.vector_stores: Dict[str, FAISS] = {}
+        self.documents = ChunkStore()
+        self.file_hashes: Dict[str, str] = {}
+        self.index_version: Optional[str] = None
+        self.lexical_index = LexicalIndex()
+        self.router: Optional[CentroidRouter] = None
+        self.rrf_k = 60
+        self.dedup_threshold = 0.95
+        self.adjacent_dedup_threshold = 0.85
+        self.dedup_candidates = 2
+        self.read_only = False
+        self._position_maps: Dict[str, Dict[str, int]] = {}
+        self._search_executor = ThreadPoolExecutor(max_workers=search_workers) if search_workers else None
+
+    def close(self):
+        """Останавливает пул поиска по разделам"""
+        if self._search_executor is not None:
+            self._search_executor.shutdown()
+            self._search_executor = None
 
-    def load_and_process_files(self, code_dir: Path, doc_dir: Path) -> List[Document]:
-        """Загружает файлы из директорий и создает чанки"""
+    @staticmethod
+    def _iter_source_files(code_dir: Path, doc_dir: Path, code_globs: Sequence[str] = DEFAULT_CODE_GLOBS,
+                           doc_globs: Sequence[str] = DEFAULT_DOC_GLOBS) -> Iterator[Tuple[Path, Path, str]]:
+        """Перечисляет файлы корпуса как (путь, базовая директория, тип)"""
+        for base_dir, globs, doc_type in ((code_dir, code_globs, "code"), (doc_dir, doc_globs, "doc")):
+            seen = set()
+            for pattern in globs:
+                for filepath in sorted(base_dir.rglob(pattern)):
+                    if filepath not in seen and filepath.is_file():
+                        seen.add(filepath)
+                        yield filepath, base_dir, doc_type
+
+    def iter_document_batches(self, code_dir: Path, doc_dir: Path, batch_size: int = 256,
+                              max_workers: Optional[int] = None,
+                              code_globs: Sequence[str] = DEFAULT_CODE_GLOBS,
+                              doc_globs: Sequence[str] = DEFAULT_DOC_GLOBS) -> Iterator[List[Document]]:
+        """Потоково разбивает файлы на чанки в пуле процессов и отдает их батчами.
+
+        Одновременно в обработке находится ограниченное число файлов, поэтому
+        пиковое потребление памяти не зависит от размера корпуса.
+        Хэши файлов накапливаются в self.file_hashes.
+        """
         
-        print("Загрузка и обработка файлов...")
-        documents = []
+        self.file_hashes = {}
+        tasks = (
+            (filepath, base_dir, doc_type, self.chunk_size, self.chunk_overlap)
+            for filepath, base_dir, doc_type in self._iter_source_files(code_dir, doc_dir, code_globs, doc_globs)
+        )
         
-   
-        print(f"Обработка кода из {code_dir}")
-        code_files = list(code_dir.rglob("*.py"))
-        for i, filepath in enumerate(code_files):
-            try:
-                text = filepath.read_text(encoding="utf-8")
-                if len(text.strip()) < 10: 
-                    continue
-                    
-                chunks = self.text_splitter.split_text(text)
-                for j, chunk in enumerate(chunks):
-                    metadata = {
-                        "file_id": filepath.name,
-                        "chunk_index": j,
-                        "type": "code",
-                        "relative_path": str(filepath.relative_to(code_dir)),
-                        "content_summary": self._extract_code_summary(chunk)
-                    }
-                    documents.append(Document(page_content=chunk, metadata=metadata))
-                
-                if (i + 1) % 10 == 0:
-                    print(f"  Обработано {i + 1}/{len(code_files)} файлов кода")
-                    
-            except Exception as e:
-                print(f"Ошибка при чтении {filepath}: {e}")
-
-        print(f"Загружено {len(code_files)} файлов кода")
+        if max_workers == 1:
+            results = map(_chunk_file_worker, tasks)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=max_workers)
+            window = (max_workers or os.cpu_count() or 1) * 4
+            results = _bounded_map(executor, _chunk_file_worker, tasks, window=window)
         
-       
-        print(f"Обработка документации из {doc_dir}")
-        doc_files = list(doc_dir.rglob("*.md"))
-        for i, filepath in enumerate(doc_files):
-            try:
-                text = filepath.read_text(encoding="utf-8")
-                if len(text.strip()) < 10:
+        batch = []
+        processed = 0
+        try:
+            for filepath, key, content_hash, documents, error in results:
+                processed += 1
+                if error is not None:
+                    print(f"Ошибка при чтении {filepath}: {error}")
                     continue
-                    
-                chunks = self.text_splitter.split_text(text)
-                for j, chunk in enumerate(chunks):
-                    metadata = {
-                        "doc_id": filepath.name,
-                        "chunk_index": j,
-                        "type": "doc",
-                        "relative_path": str(filepath.relative_to(doc_dir)),
-                        "content_summary": self._extract_doc_summary(chunk)
-                    }
-                    documents.append(Document(page_content=chunk, metadata=metadata))
-                
-                if (i + 1) % 5 == 0:
-                    print(f"  Обработано {i + 1}/{len(doc_files)} файлов документации")
-                    
-            except Exception as e:
-                print(f"Ошибка при чтении {filepath}: {e}")
+                self.file_hashes[key] = content_hash
+                batch.extend(documents)
+                if processed % 50 == 0:
+                    print(f"  Обработано {processed} файлов")
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        
+        print(f"Обработано {processed} файлов")
 
-        print(f"Загружено {len(doc_files)} файлов документации")
+    def load_and_process_files(self, code_dir: Path, doc_dir: Path, max_workers: Optional[int] = None,
+                               code_globs: Sequence[str] = DEFAULT_CODE_GLOBS,
+                               doc_globs: Sequence[str] = DEFAULT_DOC_GLOBS) -> "ChunkStore":
+        """Загружает файлы из директорий и создает чанки в компактном ChunkStore"""
+        
+        print("Загрузка и обработка файлов...")
+        print(f"Обработка кода из {code_dir} и документации из {doc_dir}")
+        documents = ChunkStore()
+        for batch in self.iter_document_batches(code_dir, doc_dir, max_workers=max_workers,
+                                                code_globs=code_globs, doc_globs=doc_globs):
+            documents.extend(batch)
         
         self.documents = documents
-        print(f"Всего создано {len(documents)} чанков")
-        print(f"  - Код: {len([d for d in documents if d.metadata['type'] == 'code'])}")
-        print(f"  - Документация: {len([d for d in documents if d.metadata['type'] == 'doc'])}")
+        counts = documents.count_by_type()
+        print(f"Всего создано {len(documents)} чанков ({documents.nbytes() / 2 ** 20:.1f} МБ)")
+        print(f"  - Код: {counts['code']}")
+        print(f"  - Документация: {counts['doc']}")
         
         return documents
 
-    def _extract_code_summary(self, chunk: str) -> str:
+    @staticmethod
+    def _content_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _process_file(self, text: str, filepath: Path, base_dir: Path, doc_type: str) -> List[Document]:
+        """Разбивает содержимое одного файла на чанки с метаданными"""
+        return _split_file_into_documents(text, filepath, base_dir, doc_type, self.text_splitter, self.chunk_size)
+
+    @staticmethod
+    def _extract_code_summary(chunk: str) -> str:
         """Извлекает краткое описание из кода"""
         lines = chunk.split('\n')
         summary_parts = []
@@ -162,7 +1010,8 @@ class SmartCodeDocSystem:
                 
         return "; ".join(summary_parts[:3]) if summary_parts else "Code block"
 
-    def _extract_doc_summary(self, chunk: str) -> str:
+    @staticmethod
+    def _extract_doc_summary(chunk: str) -> str:
         """Извлекает краткое описание из документации"""
         lines = chunk.split('\n')
         for line in lines[:5]:
@@ -173,28 +1022,469 @@ class SmartCodeDocSystem:
                 return f"Content: {line[:60]}..."
         return "Documentation block"
 
-    def create_vector_store(self, save_path: str = "vector_store"):
-        """Создает и сохраняет векторное хранилище"""
+    def _embed_batch_with_retry(self, texts: List[str], max_retries: int, backoff: float) -> List[List[float]]:
+        """Векторизует один батч, повторяя запрос с экспоненциальной задержкой"""
+        for attempt in range(max_retries + 1):
+            try:
+                return self.embeddings.embed_documents(texts)
+            except Exception as e:
+                if attempt == max_retries:
+                    raise
+                delay = backoff * (2 ** attempt)
+                print(f"Ошибка векторизации батча ({e}), повтор через {delay:.1f} с")
+                time.sleep(delay)
+
+    @staticmethod
+    def _batch_fingerprint(texts: List[str]) -> str:
+        digest = hashlib.sha1()
+        for text in texts:
+            digest.update(text.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _embed_documents_batched(self, documents: List[Document], batch_size: int, max_workers: int,
+                                 max_retries: int, backoff: float, checkpoint_dir: str) -> np.ndarray:
+        """Векторизует документы батчами в пуле потоков с контрольными точками на диске"""
         
-        if not self.documents:
-            raise ValueError("Нет документов для векторизации")
+        batches = [
+            [doc.page_content for doc in documents[i:i + batch_size]]
+            for i in range(0, len(documents), batch_size)
+        ]
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        
+        results: List[Optional[np.ndarray]] = [None] * len(batches)
+        paths = []
+        pending = []
+        for i, texts in enumerate(batches):
+            path = os.path.join(checkpoint_dir, f"batch_{self._batch_fingerprint(texts)}.npy")
+            paths.append(path)
+            if os.path.exists(path):
+                results[i] = np.load(path)
+            else:
+                pending.append(i)
+        
+        if len(pending) < len(batches):
+            print(f"Восстановлено {len(batches) - len(pending)}/{len(batches)} батчей из контрольных точек")
+        
+        start = time.perf_counter()
+        done_chunks = 0
+        done_tokens = 0
+        errors = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self._embed_batch_with_retry, batches[i], max_retries, backoff): i
+                for i in pending
+            }
+            for n, future in enumerate(as_completed(futures), start=1):
+                i = futures[future]
+                try:
+                    vectors = np.asarray(future.result(), dtype=np.float32)
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                
+                tmp_path = paths[i] + ".tmp.npy"
+                np.save(tmp_path, vectors)
+                os.replace(tmp_path, paths[i])
+                results[i] = vectors
+                
+                done_chunks += len(batches[i])
+                done_tokens += sum(_estimate_tokens(text) for text in batches[i])
+                elapsed = max(time.perf_counter() - start, 1e-9)
+                print(f"  Батч {n}/{len(pending)}: {done_chunks / elapsed:.1f} чанков/с, "
+                      f"{done_tokens / elapsed:.0f} токенов/с")
+        
+        if errors:
+            raise RuntimeError(
+                f"Не удалось векторизовать {len(errors)} батчей, запустите построение повторно "
+                f"для продолжения: {errors[0]}"
+            )
+        
+        return np.vstack(results)
+
+    def _build_store(self, batches: Iterable[List[Document]], save_path: str, batch_size: int,
+                     max_workers: int, max_retries: int, backoff: float, checkpoint_dir: Optional[str]):
+        """Векторизует поток батчей документов, наполняет FAISS и сохраняет его с манифестом"""
+        
+        checkpoint_dir = checkpoint_dir or os.path.join(save_path, ".checkpoints")
         
         print("Создание векторного хранилища...")
-        self.vector_store = FAISS.from_documents(self.documents, self.embeddings)
+        start = time.perf_counter()
+        self.vector_stores = {}
+        self.lexical_index = LexicalIndex()
+        self.read_only = False
+        self._position_maps = {}
+        manifest: Dict[str, dict] = {}
+        total = 0
+        for documents in batches:
+            if not documents:
+                continue
+            vectors = self._embed_documents_batched(
+                documents, batch_size, max_workers, max_retries, backoff, checkpoint_dir
+            )
+            ids = self._add_documents(documents, vectors)
+            
+            for doc, chunk_id in zip(documents, ids):
+                key = _file_key(doc.metadata["type"], doc.metadata["relative_path"])
+                manifest.setdefault(key, {"hash": None, "ids": []})["ids"].append(chunk_id)
+            total += len(documents)
+        
+        if not self.vector_stores:
+            raise ValueError("Нет документов для векторизации")
+        
+        elapsed = time.perf_counter() - start
+        print(f"Векторизовано {total} чанков за {elapsed:.1f} с")
+        
+        if self.index_config.index_type != "flat":
+            for doc_type, store in self.vector_stores.items():
+                print(f"Построение индекса {self.index_config.index_type} для {doc_type}")
+                store.index = build_faiss_index(store.index.reconstruct_n(0, store.index.ntotal), self.index_config)
+        
+        for key, content_hash in self.file_hashes.items():
+            manifest.setdefault(key, {"hash": None, "ids": []})["hash"] = content_hash
         
         print(f"Сохранение в {save_path}")
-        self.vector_store.save_local(save_path)
+        self.index_version = uuid.uuid4().hex
+        self._save_partitions(save_path)
+        self._write_manifest(save_path, manifest)
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
         print("Векторное хранилище создано и сохранено")
 
-    def load_vector_store(self, load_path: str = "vector_store") -> bool:
-        """Загружает существующее векторное хранилище"""
+    def create_vector_store(self, save_path: str = "vector_store", batch_size: int = 64,
+                            max_workers: int = 4, max_retries: int = 5, backoff: float = 1.0,
+                            checkpoint_dir: Optional[str] = None):
+        """Создает и сохраняет векторное хранилище из self.documents.
+
+        Эмбеддинги считаются батчами параллельно; готовые батчи сохраняются
+        в checkpoint_dir, поэтому прерванное построение продолжается с места остановки.
+        """
+        
+        if not self.documents:
+            raise ValueError("Нет документов для векторизации")
+        
+        # Document материализуются порциями, кратными batch_size, чтобы контрольные точки совпадали
+        self._build_store(self.documents.iter_batches(batch_size * 16), save_path, batch_size, max_workers,
+                          max_retries, backoff, checkpoint_dir)
+
+    def build_vector_store(self, code_dir: Path, doc_dir: Path, save_path: str = "vector_store",
+                           ingest_batch_size: int = 1024, ingest_workers: Optional[int] = None,
+                           code_globs: Sequence[str] = DEFAULT_CODE_GLOBS,
+                           doc_globs: Sequence[str] = DEFAULT_DOC_GLOBS, batch_size: int = 64,
+                           max_workers: int = 4, max_retries: int = 5, backoff: float = 1.0,
+                           checkpoint_dir: Optional[str] = None):
+        """Строит хранилище потоково: чанки из пула процессов сразу идут на векторизацию,
+        не накапливаясь в self.documents"""
+        
+        batches = self.iter_document_batches(
+            code_dir, doc_dir, batch_size=ingest_batch_size, max_workers=ingest_workers,
+            code_globs=code_globs, doc_globs=doc_globs
+        )
+        self._build_store(batches, save_path, batch_size, max_workers, max_retries, backoff, checkpoint_dir)
+
+    @staticmethod
+    def _read_manifest(path: str) -> Optional[dict]:
+        manifest_path = os.path.join(path, "manifest.json")
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self, path: str, files: Dict[str, dict]):
+        manifest_path = os.path.join(path, "manifest.json")
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "index_version": self.index_version, "files": files}, f, ensure_ascii=False)
+        os.replace(tmp_path, manifest_path)
+
+    def update_vector_store(self, code_dir: Path, doc_dir: Path, save_path: str = "vector_store",
+                            code_globs: Sequence[str] = DEFAULT_CODE_GLOBS,
+                            doc_globs: Sequence[str] = DEFAULT_DOC_GLOBS, **build_kwargs) -> Dict[str, int]:
+        """Инкрементально обновляет сохраненное хранилище.
+
+        Перевекторизуются только новые и измененные файлы (по хэшу содержимого),
+        векторы удаленных файлов удаляются. Если манифеста нет, хранилище строится заново.
+        """
+        
+        manifest = self._read_manifest(save_path)
+        if manifest is None or not self.load_vector_store(save_path, mmap=False):
+            print("Манифест не найден, выполняется полное построение")
+            self.build_vector_store(code_dir, doc_dir, save_path, code_globs=code_globs,
+                                    doc_globs=doc_globs, **build_kwargs)
+            return {"added": len(self.file_hashes), "modified": 0, "removed": 0,
+                    "chunks": sum(len(store.index_to_docstore_id) for store in self.vector_stores.values())}
+        
+        manifest = manifest["files"]
+        print("Поиск изменений...")
+        current = {}
+        changed_documents = []
+        stats = {"added": 0, "modified": 0, "removed": 0, "chunks": 0}
+        for filepath, base_dir, doc_type in self._iter_source_files(code_dir, doc_dir, code_globs, doc_globs):
+            key = _file_key(doc_type, str(filepath.relative_to(base_dir)))
+            try:
+                text = filepath.read_text(encoding="utf-8")
+            except Exception as e:
+                print(f"Ошибка при чтении {filepath}: {e}")
+                if key in manifest:
+                    current[key] = manifest[key]
+                continue
+            
+            content_hash = self._content_hash(text)
+            previous = manifest.get(key)
+            if previous is not None and previous["hash"] == content_hash:
+                current[key] = previous
+                continue
+            
+            stats["modified" if previous is not None else "added"] += 1
+            documents = self._process_file(text, filepath, base_dir, doc_type)
+            changed_documents.extend(documents)
+            current[key] = {"hash": content_hash, "ids": [_chunk_id(d.metadata) for d in documents]}
+        
+        stale_ids = []
+        for key, entry in manifest.items():
+            if key not in current:
+                stats["removed"] += 1
+                stale_ids.extend(entry["ids"])
+            elif current[key] is not entry:
+                stale_ids.extend(entry["ids"])
+        
+        print(f"Добавлено: {stats['added']}, изменено: {stats['modified']}, удалено: {stats['removed']} файлов")
+        if stale_ids:
+            self._delete_ids(stale_ids)
+        
+        if changed_documents:
+            checkpoint_dir = build_kwargs.pop("checkpoint_dir", None) or os.path.join(save_path, ".checkpoints")
+            vectors = self._embed_documents_batched(
+                changed_documents,
+                build_kwargs.get("batch_size", 64),
+                build_kwargs.get("max_workers", 4),
+                build_kwargs.get("max_retries", 5),
+                build_kwargs.get("backoff", 1.0),
+                checkpoint_dir
+            )
+            self._add_documents(changed_documents, vectors)
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        
+        stats["chunks"] = len(changed_documents)
+        if stale_ids or changed_documents:
+            print(f"Сохранение в {save_path}")
+            self.index_version = uuid.uuid4().hex
+            self._save_partitions(save_path)
+        self._write_manifest(save_path, current)
+        self.file_hashes = {key: entry["hash"] for key, entry in current.items()}
+        print("Векторное хранилище обновлено")
+        return stats
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ValueError("Хранилище загружено через mmap только для чтения, загрузите его с mmap=False")
+
+    def _add_to_partition(self, doc_type: str, text_embeddings: List[Tuple[str, Sequence[float]]],
+                          metadatas: List[dict], ids: List[str]):
+        self._check_writable()
+        self._position_maps.pop(doc_type, None)
+        store = self.vector_stores.get(doc_type)
+        if store is None:
+            self.vector_stores[doc_type] = FAISS.from_embeddings(
+                text_embeddings=text_embeddings,
+                embedding=self.embeddings,
+                metadatas=metadatas,
+                ids=ids
+            )
+        else:
+            store.add_embeddings(text_embeddings=text_embeddings, metadatas=metadatas, ids=ids)
+        
+        for (text, _), chunk_id in zip(text_embeddings, ids):
+            self.lexical_index.add(chunk_id, doc_type, text)
+
+    def _add_documents(self, documents: List[Document], vectors: np.ndarray) -> List[str]:
+        """Раскладывает документы с готовыми векторами по индексам их типа"""
+        grouped: Dict[str, Tuple[list, list, list]] = {}
+        ids = []
+        for doc, vector in zip(documents, vectors):
+            chunk_id = _chunk_id(doc.metadata)
+            text_embeddings, metadatas, type_ids = grouped.setdefault(doc.metadata["type"], ([], [], []))
+            text_embeddings.append((doc.page_content, vector))
+            metadatas.append(doc.metadata)
+            type_ids.append(chunk_id)
+            ids.append(chunk_id)
+        
+        for doc_type, (text_embeddings, metadatas, type_ids) in grouped.items():
+            self._add_to_partition(doc_type, text_embeddings, metadatas, type_ids)
+        return ids
+
+    def _delete_ids(self, ids: List[str]):
+        import faiss
+        
+        self._check_writable()
+        grouped: Dict[str, List[str]] = {}
+        for chunk_id in ids:
+            grouped.setdefault(chunk_id.split(":", 1)[0], []).append(chunk_id)
+        for doc_type, type_ids in grouped.items():
+            store = self.vector_stores.get(doc_type)
+            if store is None:
+                continue
+            self._position_maps.pop(doc_type, None)
+            if faiss.try_extract_index_ivf(store.index) is not None:
+                # IVF не перенумеровывает векторы при удалении, а позиции в
+                # index_to_docstore_id должны совпадать с идентификаторами FAISS
+                self._rebuild_partition_without(doc_type, set(type_ids))
+                continue
+            try:
+                store.delete(type_ids)
+            except RuntimeError:
+                # HNSW не поддерживает удаление, индекс пересобирается без удаленных векторов
+                self._rebuild_partition_without(doc_type, set(type_ids))
+        self.lexical_index.delete(ids)
+
+    def _rebuild_partition_without(self, doc_type: str, removed_ids: set):
+        import faiss
+        
+        store = self.vector_stores[doc_type]
+        keep = [
+            (position, doc_id) for position, doc_id in sorted(store.index_to_docstore_id.items())
+            if doc_id not in removed_ids
+        ]
+        removed = [doc_id for doc_id in store.index_to_docstore_id.values() if doc_id in removed_ids]
+        positions = [position for position, _ in keep]
+        if faiss.try_extract_index_ivf(store.index) is not None:
+            store.index = ivf_keep_positions(store.index, positions)
+        else:
+            # HNSW,Flat хранит векторы без потерь, пересборка по ним точна
+            vectors = store.index.reconstruct_n(0, store.index.ntotal)
+            store.index = build_faiss_index(vectors[positions], self.index_config)
+        store.index_to_docstore_id = {i: doc_id for i, (_, doc_id) in enumerate(keep)}
+        if removed:
+            store.docstore.delete(removed)
+
+    def _save_partitions(self, save_path: str):
+        """Сохраняет каждый раздел как index.faiss + docs.arrow (строка файла = позиция в индексе)"""
+        import faiss
+        
+        for doc_type, store in self.vector_stores.items():
+            partition_path = os.path.join(save_path, doc_type)
+            os.makedirs(partition_path, exist_ok=True)
+            documents = [
+                store.docstore.search(store.index_to_docstore_id[position])
+                for position in range(store.index.ntotal)
+            ]
+            ColumnarDocstore.write(os.path.join(partition_path, "docs.arrow"), documents)
+            
+            index_path = os.path.join(partition_path, "index.faiss")
+            faiss.write_index(store.index, index_path + ".tmp")
+            os.replace(index_path + ".tmp", index_path)
+            
+            legacy_path = os.path.join(partition_path, "index.pkl")
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
+        self.lexical_index.save(os.path.join(save_path, "lexical.json"))
+        
+        router_path = os.path.join(save_path, "router.npz")
+        self.router = CentroidRouter.from_stores(self.vector_stores)
+        if self.router is not None:
+            self.router.save(router_path)
+        elif os.path.exists(router_path):
+            os.remove(router_path)
+
+    def _load_partition(self, partition_path: str, mmap: bool) -> FAISS:
+        import faiss
+        
+        index_path = os.path.join(partition_path, "index.faiss")
+        docs_path = os.path.join(partition_path, "docs.arrow")
+        if not os.path.exists(docs_path):
+            print(f"Загрузка {partition_path} в старом формате (pickle)")
+            return FAISS.load_local(partition_path, self.embeddings, allow_dangerous_deserialization=True)
+        
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) if mmap else 0
+        index = faiss.read_index(index_path, flags)
+        docstore = ColumnarDocstore.open(docs_path, mmap=mmap)
+        return FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=dict(enumerate(docstore.row_ids))
+        )
+
+    def _build_lexical_index(self) -> LexicalIndex:
+        """Строит лексический индекс по содержимому загруженных хранилищ"""
+        index = LexicalIndex()
+        for doc_type, store in self.vector_stores.items():
+            for doc_id in store.index_to_docstore_id.values():
+                doc = store.docstore.search(doc_id)
+                if isinstance(doc, Document):
+                    index.add(doc_id, doc_type, doc.page_content)
+        return index
+
+    def _partition_store(self, store: FAISS):
+        """Разделяет общий индекс старого формата на индексы по типам контента"""
+        vectors = store.index.reconstruct_n(0, store.index.ntotal)
+        grouped: Dict[str, Tuple[list, list, list]] = {}
+        for position, doc_id in store.index_to_docstore_id.items():
+            doc = store.docstore.search(doc_id)
+            text_embeddings, metadatas, ids = grouped.setdefault(doc.metadata.get("type", "doc"), ([], [], []))
+            text_embeddings.append((doc.page_content, vectors[position]))
+            metadatas.append(doc.metadata)
+            ids.append(doc_id)
+        
+        self.vector_stores = {}
+        self.lexical_index = LexicalIndex()
+        for doc_type, (text_embeddings, metadatas, ids) in grouped.items():
+            self._add_to_partition(doc_type, text_embeddings, metadatas, ids)
+
+    def load_vector_store(self, load_path: str = "vector_store", mmap: bool = True) -> bool:
+        """Загружает существующее векторное хранилище.
+
+        При mmap=True индексы и чанки отображаются в память и разделяются между
+        процессами, но хранилище доступно только для чтения.
+        """
         
         if os.path.exists(load_path):
             try:
                 print(f"Загрузка векторного хранилища из {load_path}")
-                self.vector_store = FAISS.load_local(
-                    load_path, self.embeddings, allow_dangerous_deserialization=True
-                )
+                self.vector_stores = {}
+                self.lexical_index = LexicalIndex()
+                self.read_only = False
+                self._position_maps = {}
+                for doc_type in CONTENT_TYPES:
+                    partition_path = os.path.join(load_path, doc_type)
+                    if os.path.exists(os.path.join(partition_path, "index.faiss")):
+                        self.vector_stores[doc_type] = self._load_partition(partition_path, mmap)
+                        if isinstance(self.vector_stores[doc_type].docstore, ColumnarDocstore):
+                            self.read_only = self.read_only or mmap
+                
+                if not self.vector_stores and os.path.exists(os.path.join(load_path, "index.faiss")):
+                    print("Найден общий индекс, разделение по типам контента")
+                    self._partition_store(FAISS.load_local(
+                        load_path, self.embeddings, allow_dangerous_deserialization=True
+                    ))
+                
+                if not self.vector_stores:
+                    print("Индексы не найдены")
+                    return False
+                
+                for store in self.vector_stores.values():
+                    apply_search_params(store.index, self.index_config)
+                
+                lexical_path = os.path.join(load_path, "lexical.json")
+                if os.path.exists(lexical_path):
+                    self.lexical_index = LexicalIndex.load(lexical_path)
+                elif not len(self.lexical_index):
+                    self.lexical_index = self._build_lexical_index()
+                
+                router_path = os.path.join(load_path, "router.npz")
+                if os.path.exists(router_path):
+                    self.router = CentroidRouter.load(router_path)
+                else:
+                    try:
+                        self.router = CentroidRouter.from_stores(self.vector_stores)
+                    except RuntimeError as e:
+                        print(f"Не удалось вычислить центроиды, тип поиска определяется по ключевым словам: {e}")
+                        self.router = None
+                
+                manifest = self._read_manifest(load_path)
+                if manifest is not None and manifest.get("index_version"):
+                    self.index_version = manifest["index_version"]
+                else:
+                    self.index_version = f"legacy-{int(os.path.getmtime(load_path))}"
                 print("Векторное хранилище загружено")
                 return True
             except Exception as e:
@@ -202,73 +1492,892 @@ class SmartCodeDocSystem:
                 return False
         return False
 
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """Меняет точность поиска загруженных IVF / HNSW индексов без перестроения"""
+        if nprobe is not None:
+            self.index_config.nprobe = nprobe
+        if ef_search is not None:
+            self.index_config.ef_search = ef_search
+        for store in self.vector_stores.values():
+            apply_search_params(store.index, self.index_config)
+
+    @staticmethod
+    def _quotas(search_type: str, k: int) -> Dict[str, int]:
+        """Сколько чанков каждого типа запрашивать для данного режима поиска"""
+        if search_type == "code-first":
+            return {"code": k // 2 + 1, "doc": k // 2}
+        if search_type == "doc-first":
+            return {"code": k // 2, "doc": k // 2 + 1}
+        return {"code": k // 2, "doc": k // 2}
+
+    def _route(self, query: str, query_vector: Sequence[float], k: int) -> Tuple[str, Dict[str, int], Optional[float]]:
+        """Тип поиска, квоты разделов и доля кода для запроса.
+
+        При наличии центроидов квоты задаются долей кода по эмбеддингу запроса.
+        Явное намерение из QueryAnalyzer ("пример", "как работает") сдвигает долю
+        за порог своего режима. Без центроидов используется только QueryAnalyzer.
+        """
+        search_type = self.query_analyzer.analyze_query(query)
+        code_ratio = self.router.code_ratio(query_vector) if self.router is not None else None
+        if code_ratio is None:
+            return search_type, self._quotas(search_type, k), None
+        if search_type == "code-first":
+            code_ratio = max(code_ratio, 0.5 + self.router.balanced_margin)
+        elif search_type == "doc-first":
+            code_ratio = min(code_ratio, 0.5 - self.router.balanced_margin)
+        return self.router.search_type(code_ratio), CentroidRouter.quotas(code_ratio, k), code_ratio
+
+    def _candidate_quotas(self, quotas: Dict[str, int]) -> Dict[str, int]:
+        """Квоты с запасом кандидатов, чтобы после удаления дубликатов осталось k чанков"""
+        return {doc_type: quota * self.dedup_candidates for doc_type, quota in quotas.items()}
+
+    def _search_partition(self, doc_type: str, query_vector: List[float], k: int,
+                          query: Optional[str] = None) -> List[Tuple[Document, float]]:
+        """Ищет k чанков одного типа; при наличии текста запроса объединяет
+        векторную и лексическую выдачу через reciprocal rank fusion"""
+        store = self.vector_stores.get(doc_type)
+        if store is None or k <= 0:
+            return []
+        vector_hits = [
+            (doc, _distance_to_similarity(distance))
+            for doc, distance in store.similarity_search_with_score_by_vector(query_vector, k=k)
+        ]
+        if query is None:
+            return vector_hits
+        
+        lexical_hits = self.lexical_index.search(query, k=k, doc_type=doc_type)
+        return self._fuse(store, vector_hits, lexical_hits, k)
+
+    def _fuse(self, store: FAISS, vector_hits: List[Tuple[Document, float]],
+              lexical_hits: List[Tuple[str, float]], k: int) -> List[Tuple[Document, float]]:
+        """Reciprocal rank fusion; оценка нормируется на максимально возможную, чтобы лежать в [0, 1]"""
+        fused: Dict[str, float] = {}
+        documents: Dict[str, Document] = {}
+        for rank, (doc, _) in enumerate(vector_hits):
+            fused[doc.id] = fused.get(doc.id, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+            documents[doc.id] = doc
+        for rank, (doc_id, _) in enumerate(lexical_hits):
+            if doc_id not in documents:
+                doc = store.docstore.search(doc_id)
+                if not isinstance(doc, Document):
+                    continue
+                documents[doc_id] = doc
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        
+        best = (bool(vector_hits) + bool(lexical_hits)) / (self.rrf_k + 1)
+        ranked = heapq.nlargest(k, fused.items(), key=lambda item: item[1])
+        return [(documents[doc_id], score / best) for doc_id, score in ranked]
+
+    def _search_partitions(self, query_vector: List[float], quotas: Dict[str, int],
+                           query: Optional[str] = None) -> Dict[str, List[Tuple[Document, float]]]:
+        """Ищет в индексах каждого типа ровно нужное число чанков
+        (параллельно, если задан пул search_workers)"""
+        if self._search_executor is None:
+            return {
+                doc_type: self._search_partition(doc_type, query_vector, quota, query)
+                for doc_type, quota in quotas.items()
+            }
+        futures = {
+            doc_type: self._search_executor.submit(self._search_partition, doc_type, query_vector, quota, query)
+            for doc_type, quota in quotas.items()
+        }
+        return {doc_type: future.result() for doc_type, future in futures.items()}
+
     def smart_search(self, query: str, k: int = 6, related_k: int = 2) -> SearchResult:
         """Умный поиск с адаптивным выбором типа контента"""
         
-        if self.vector_store is None:
+        if not self.vector_stores:
             raise ValueError("Векторное хранилище не инициализировано")
         
-    
-        search_type = self.query_analyzer.analyze_query(query)
+        start = time.perf_counter()
+        embed_with_hit = getattr(self.embeddings, "embed_query_with_hit", None)
+        if embed_with_hit is not None:
+            query_vector, cache_hit = embed_with_hit(query)
+        else:
+            query_vector, cache_hit = self.embeddings.embed_query(query), None
+        timings = {"embed": _elapsed_ms(start)}
         
-    
-        all_results = self.vector_store.similarity_search(query, k=k*2)
+        start = time.perf_counter()
+        search_type, quotas, code_ratio = self._route(query, query_vector, k)
+        timings["analyze"] = _elapsed_ms(start)
         
-        if search_type == "code-first":
-      
-            code_chunks = [d for d in all_results if d.metadata.get("type") == "code"][:k//2+1]
-            doc_chunks = [d for d in all_results if d.metadata.get("type") == "doc"][:k//2]
-            primary_chunks = code_chunks
-            related_chunks = doc_chunks
-            
-        elif search_type == "doc-first":
-     
-            doc_chunks = [d for d in all_results if d.metadata.get("type") == "doc"][:k//2+1]
-            code_chunks = [d for d in all_results if d.metadata.get("type") == "code"][:k//2]
-            primary_chunks = doc_chunks
-            related_chunks = code_chunks
+        start = time.perf_counter()
+        results = self._search_partitions(query_vector, self._candidate_quotas(quotas), query)
+        timings["search"] = _elapsed_ms(start)
+        return self._assemble_result(search_type, results, k, quotas, code_ratio, timings, cache_hit)
+
+    def smart_search_batch(self, queries: List[str], k: int = 6) -> List[SearchResult]:
+        """Умный поиск для набора запросов.
+
+        Повторяющиеся запросы ищутся и векторизуются один раз; в timings["embed"]
+        записывается среднее время векторизации на один запрос.
+        """
+        
+        if not self.vector_stores:
+            raise ValueError("Векторное хранилище не инициализировано")
+        
+        unique_queries = list(dict.fromkeys(queries))
+        start = time.perf_counter()
+        embed_with_hits = getattr(self.embeddings, "embed_queries_with_hits", None)
+        if embed_with_hits is not None:
+            query_vectors, cache_hits = embed_with_hits(unique_queries)
+        else:
+            query_vectors = [self.embeddings.embed_query(query) for query in unique_queries]
+            cache_hits = [None] * len(unique_queries)
+        embed_ms = _elapsed_ms(start) / max(len(unique_queries), 1)
+        
+        results = {}
+        for query, query_vector, cache_hit in zip(unique_queries, query_vectors, cache_hits):
+            start = time.perf_counter()
+            search_type, quotas, code_ratio = self._route(query, query_vector, k)
+            timings = {"embed": embed_ms, "analyze": _elapsed_ms(start)}
             
-        else:  
+            start = time.perf_counter()
+            partitions = self._search_partitions(query_vector, self._candidate_quotas(quotas), query)
+            timings["search"] = _elapsed_ms(start)
+            results[query] = self._assemble_result(search_type, partitions, k, quotas, code_ratio, timings, cache_hit)
+        return [results[query] for query in queries]
 
-            code_chunks = [d for d in all_results if d.metadata.get("type") == "code"][:k//2]
-            doc_chunks = [d for d in all_results if d.metadata.get("type") == "doc"][:k//2]
-            primary_chunks = doc_chunks + code_chunks
-            related_chunks = []
+    async def asmart_search(self, query: str, k: int = 6, related_k: int = 2) -> SearchResult:
+        """Асинхронный умный поиск: эмбеддинг запроса не блокирует цикл событий,
+        поиск по индексам выполняется параллельно в пуле потоков"""
+        
+        if not self.vector_stores:
+            raise ValueError("Векторное хранилище не инициализировано")
+        
+        start = time.perf_counter()
+        embed_with_hit = getattr(self.embeddings, "aembed_query_with_hit", None)
+        if embed_with_hit is not None:
+            query_vector, cache_hit = await embed_with_hit(query)
+        else:
+            query_vector, cache_hit = await self.embeddings.aembed_query(query), None
+        timings = {"embed": _elapsed_ms(start)}
+        
+        start = time.perf_counter()
+        search_type, quotas, code_ratio = self._route(query, query_vector, k)
+        timings["analyze"] = _elapsed_ms(start)
         
+        start = time.perf_counter()
+        candidate_quotas = self._candidate_quotas(quotas)
+        loop = asyncio.get_running_loop()
+        partition_results = await asyncio.gather(*(
+            loop.run_in_executor(None, self._search_partition, doc_type, query_vector, quota, query)
+            for doc_type, quota in candidate_quotas.items()
+        ))
+        timings["search"] = _elapsed_ms(start)
+        return self._assemble_result(search_type, dict(zip(candidate_quotas, partition_results)), k, quotas,
+                                     code_ratio, timings, cache_hit)
 
-        all_documents = primary_chunks + related_chunks
-        seen_content = set()
-        unique_documents = []
+    def _assemble_result(self, search_type: str, results: Dict[str, List[Tuple[Document, float]]], k: int,
+                         quotas: Optional[Dict[str, int]] = None, code_ratio: Optional[float] = None,
+                         timings: Optional[Dict[str, float]] = None,
+                         cache_hit: Optional[bool] = None) -> SearchResult:
+        """Собирает SearchResult из результатов поиска по индексам.
+
+        Кандидаты без точных и смысловых дубликатов берутся по порядку, пока не
+        заполнится квота своего типа.
+        """
+        
+        timings = dict(timings or {})
+        start = time.perf_counter()
+        code_chunks = results.get("code", [])
+        doc_chunks = results.get("doc", [])
+        
+        if search_type == "code-first":
+            primary_type = "code"
+            candidates = code_chunks + doc_chunks
+        elif search_type == "doc-first":
+            primary_type = "doc"
+            candidates = doc_chunks + code_chunks
+        else:
+            primary_type = None
+            candidates = sorted(doc_chunks + code_chunks, key=lambda pair: pair[1], reverse=True)
         
-        for doc in all_documents:
-            content_hash = hash(doc.page_content[:100]) 
+        seen_content = set()
+        unique_candidates = []
+        for doc, score in candidates:
+            content_hash = hash(doc.page_content[:100])
             if content_hash not in seen_content:
                 seen_content.add(content_hash)
-                unique_documents.append(doc)
+                unique_candidates.append((doc, score))
+        timings["partition"] = _elapsed_ms(start)
+        
+        start = time.perf_counter()
+        duplicates = self._near_duplicates([doc for doc, _ in unique_candidates])
+        quotas = quotas or self._quotas(search_type, k)
+        taken = Counter()
+        kept = []
+        near_duplicates = 0
+        for i, (doc, _) in enumerate(unique_candidates):
+            doc_type = doc.metadata.get("type")
+            if taken[doc_type] >= quotas.get(doc_type, k):
+                continue
+            if duplicates is not None and kept and duplicates[i, kept].any():
+                near_duplicates += 1
+                continue
+            taken[doc_type] += 1
+            kept.append(i)
+        timings["dedup"] = _elapsed_ms(start)
+        
+        unique_documents = [unique_candidates[i][0] for i in kept][:k]
+        scores = [unique_candidates[i][1] for i in kept][:k]
+        counters = {
+            "candidates": len(candidates),
+            "exact_duplicates": len(candidates) - len(unique_candidates),
+            "near_duplicates": near_duplicates,
+            "documents": len(unique_documents),
+        }
+        if cache_hit is not None:
+            counters["embedding_cache_hits"] = int(cache_hit)
         
         return SearchResult(
-            documents=unique_documents[:k],
+            documents=unique_documents,
             search_type=search_type,
-            primary_chunks=primary_chunks,
-            related_chunks=related_chunks
+            primary_chunks=[doc for doc in unique_documents
+                            if primary_type is None or doc.metadata.get("type") == primary_type],
+            related_chunks=[doc for doc in unique_documents
+                            if primary_type is not None and doc.metadata.get("type") != primary_type],
+            scores=scores,
+            timings=timings,
+            counters=counters,
+            code_ratio=code_ratio
         )
 
+    def _candidate_vectors(self, documents: List[Document]) -> Optional[np.ndarray]:
+        """Восстанавливает векторы кандидатов из FAISS индексов их разделов"""
+        grouped: Dict[str, Tuple[List[int], List[int]]] = {}
+        for i, doc in enumerate(documents):
+            doc_type = doc.metadata.get("type")
+            positions = self._position_maps.get(doc_type)
+            if positions is None:
+                store = self.vector_stores.get(doc_type)
+                if store is None:
+                    return None
+                positions = {doc_id: position for position, doc_id in store.index_to_docstore_id.items()}
+                self._position_maps[doc_type] = positions
+            if doc.id not in positions:
+                return None
+            rows, type_positions = grouped.setdefault(doc_type, ([], []))
+            rows.append(i)
+            type_positions.append(positions[doc.id])
+        
+        vectors = None
+        for doc_type, (rows, type_positions) in grouped.items():
+            index = self.vector_stores[doc_type].index
+            try:
+                type_vectors = index.reconstruct_batch(np.asarray(type_positions, dtype=np.int64))
+            except RuntimeError:
+                return None
+            if vectors is None:
+                vectors = np.zeros((len(documents), type_vectors.shape[1]), dtype=np.float32)
+            vectors[rows] = type_vectors
+        return vectors
+
+    def _near_duplicates(self, documents: List[Document]) -> Optional[np.ndarray]:
+        """Матрица пар кандидатов, считающихся дубликатами.
+
+        Пара — дубликат, если косинусная близость векторов не ниже dedup_threshold,
+        а для соседних чанков одного файла — не ниже adjacent_dedup_threshold.
+        None, если векторы восстановить нельзя.
+        """
+        if len(documents) < 2 or self.dedup_threshold is None:
+            return None
+        vectors = self._candidate_vectors(documents)
+        if vectors is None:
+            return None
+        
+        unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        similarity = unit @ unit.T
+        
+        _, file_codes = np.unique(
+            [_file_key(doc.metadata.get("type", ""), doc.metadata.get("relative_path", "")) for doc in documents],
+            return_inverse=True
+        )
+        chunk_indices = np.array([doc.metadata.get("chunk_index", -2) for doc in documents], dtype=np.int64)
+        adjacent = (file_codes[:, None] == file_codes[None, :]) & (np.abs(chunk_indices[:, None] - chunk_indices[None, :]) == 1)
+        return similarity >= np.where(adjacent, self.adjacent_dedup_threshold, self.dedup_threshold)
+
+
+_WORKER_SPLITTERS: Dict[Tuple[int, int], RecursiveCharacterTextSplitter] = {}
+
+
+def _python_signature(node) -> str:
+    if isinstance(node, ast.ClassDef):
+        bases = [ast.unparse(base) for base in node.bases] + [ast.unparse(kw) for kw in node.keywords]
+        return f"class {node.name}({', '.join(bases)})" if bases else f"class {node.name}"
+    prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+    signature = f"{prefix} {node.name}({ast.unparse(node.args)})"
+    if node.returns is not None:
+        signature += f" -> {ast.unparse(node.returns)}"
+    return signature
+
+
+def _node_start(node) -> int:
+    """Первая строка узла с учетом декораторов"""
+    return min([node.lineno] + [decorator.lineno for decorator in getattr(node, "decorator_list", [])])
+
+
+def _split_python_code(text: str, text_splitter: RecursiveCharacterTextSplitter,
+                       chunk_size: int) -> List[Tuple[str, dict]]:
+    """Разбивает Python код по структуре AST.
+
+    Каждая функция, класс (без тел методов) и метод становятся отдельным чанком,
+    код модуля между ними объединяется. Комментарии над функцией, классом или
+    методом попадают в его чанк, остальные строки вне узлов AST — в код модуля,
+    так что каждая строка файла оказывается в каком-то чанке. Текстовым
+    сплиттером режутся только фрагменты длиннее chunk_size. Если файл не
+    разбирается, используется обычный сплиттер.
+    """
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return [(chunk, {}) for chunk in text_splitter.split_text(text)]
+    
+    # Номера строк ast считает только по \n, \r\n и \r; str.splitlines режет еще
+    # и по \x0c, \u2028 и т.п., из-за чего границы чанков сдвигаются
+    lines = io.StringIO(text, newline=None).readlines()
+    segments = []
+    module_run = []
+    covered = 0
+    
+    def leading_start(start: int, prev_end: int) -> int:
+        """Первая непустая строка между предыдущим узлом и start (или сам start)"""
+        for i in range(prev_end + 1, start):
+            if lines[i - 1].strip():
+                return i
+        return start
+    
+    def leading_comments(start: int) -> int:
+        """Начало блока комментариев, идущего непосредственно перед start"""
+        while start > 1 and lines[start - 2].lstrip().startswith("#"):
+            start -= 1
+        return start
+    
+    def emit(start: int, end: int, body_lines: List[str], symbol: dict):
+        body = "".join(body_lines).strip("\n")
+        if body.strip():
+            segments.append((start, end, body, symbol))
+    
+    def flush_module():
+        if module_run:
+            start, end = module_run[0][0], module_run[-1][1]
+            emit(start, end, lines[start - 1:end], {"symbol_kind": "module"})
+            module_run.clear()
+    
+    for node in tree.body:
+        start, end = leading_start(_node_start(node), covered), node.end_lineno
+        covered = end
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            flush_module()
+            emit(start, end, lines[start - 1:end], {
+                "symbol_kind": "function",
+                "qualified_name": node.name,
+                "signature": _python_signature(node),
+                "parent_class": None
+            })
+        elif isinstance(node, ast.ClassDef):
+            flush_module()
+            methods = [child for child in node.body if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef))]
+            method_starts = [leading_comments(_node_start(method)) for method in methods]
+            method_lines = set()
+            for method, method_start in zip(methods, method_starts):
+                method_lines.update(range(method_start, method.end_lineno + 1))
+            emit(start, end, [lines[i - 1] for i in range(start, end + 1) if i not in method_lines], {
+                "symbol_kind": "class",
+                "qualified_name": node.name,
+                "signature": _python_signature(node),
+                "parent_class": None,
+                "methods": [method.name for method in methods]
+            })
+            for method, method_start in zip(methods, method_starts):
+                emit(method_start, method.end_lineno, lines[method_start - 1:method.end_lineno], {
+                    "symbol_kind": "method",
+                    "qualified_name": f"{node.name}.{method.name}",
+                    "signature": _python_signature(method),
+                    "parent_class": node.name
+                })
+        else:
+            module_run.append((start, end))
+    
+    trailing_start = leading_start(len(lines) + 1, covered)
+    if trailing_start <= len(lines):
+        module_run.append((trailing_start, len(lines)))
+    flush_module()
+    
+    chunks = []
+    for start, end, body, symbol in sorted(segments, key=lambda segment: segment[0]):
+        symbol = {**symbol, "start_line": start, "end_line": end}
+        if len(body) <= chunk_size:
+            chunks.append((body, symbol))
+        else:
+            chunks.extend((part, symbol) for part in text_splitter.split_text(body))
+    return chunks
+
+
+def _symbol_summary(symbol: dict) -> Optional[str]:
+    kind = symbol.get("symbol_kind")
+    if kind == "class":
+        summary = f"Class: {symbol['qualified_name']}"
+        if symbol.get("methods"):
+            summary += f"; Methods: {', '.join(symbol['methods'][:5])}"
+        return summary
+    if kind == "function":
+        return f"Function: {symbol['qualified_name']}"
+    if kind == "method":
+        return f"Method: {symbol['qualified_name']}"
+    return None
+
+
+def _split_file_into_documents(text: str, filepath: Path, base_dir: Path, doc_type: str,
+                               text_splitter: RecursiveCharacterTextSplitter,
+                               chunk_size: int) -> List[Document]:
+    """Разбивает содержимое одного файла на чанки с метаданными"""
+    if len(text.strip()) < 10:
+        return []
+    
+    if doc_type == "code" and filepath.suffix == ".py":
+        pieces = _split_python_code(text, text_splitter, chunk_size)
+    else:
+        pieces = [(chunk, {}) for chunk in text_splitter.split_text(text)]
+    
+    documents = []
+    relative_path = str(filepath.relative_to(base_dir))
+    for j, (chunk, symbol) in enumerate(pieces):
+        if doc_type == "code":
+            metadata = {"file_id": filepath.name, **symbol}
+            summary = _symbol_summary(symbol) or SmartCodeDocSystem._extract_code_summary(chunk)
+        else:
+            metadata = {"doc_id": filepath.name}
+            summary = SmartCodeDocSystem._extract_doc_summary(chunk)
+        metadata.update({
+            "chunk_index": j,
+            "type": doc_type,
+            "relative_path": relative_path,
+            "content_summary": summary
+        })
+        documents.append(Document(page_content=chunk, metadata=metadata))
+    return documents
+
+
+def _chunk_file_worker(task) -> Tuple[Path, str, Optional[str], List[Document], Optional[str]]:
+    """Обрабатывает один файл в процессе пула: чтение, хэш и разбиение на чанки"""
+    filepath, base_dir, doc_type, chunk_size, chunk_overlap = task
+    key = _file_key(doc_type, str(filepath.relative_to(base_dir)))
+    try:
+        text = filepath.read_text(encoding="utf-8")
+    except Exception as e:
+        return filepath, key, None, [], str(e)
+    
+    splitter = _WORKER_SPLITTERS.get((chunk_size, chunk_overlap))
+    if splitter is None:
+        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        _WORKER_SPLITTERS[(chunk_size, chunk_overlap)] = splitter
+    
+    documents = _split_file_into_documents(text, filepath, base_dir, doc_type, splitter, chunk_size)
+    return filepath, key, SmartCodeDocSystem._content_hash(text), documents, None
+
+
+def _bounded_map(executor, fn, items: Iterable, window: int) -> Iterator:
+    """Как executor.map, но держит в работе не больше window задач и сохраняет порядок"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class ContextPacker:
+    """Упаковывает найденные чанки в контекст ограниченного размера.
+
+    Чанки берутся по убыванию релевантности, точные дубликаты отбрасываются,
+    соседние чанки одного файла склеиваются без перекрытия, а отбор
+    прекращается, когда исчерпан бюджет токенов.
+    """
+
+    def __init__(self, token_budget: int = 6000, max_overlap: int = 300, min_overlap: int = 20):
+        self.token_budget = token_budget
+        self.max_overlap = max_overlap
+        self.min_overlap = min_overlap
+
+    @staticmethod
+    def _fingerprint(text: str) -> str:
+        return hashlib.sha1(" ".join(text.lower().split()).encode("utf-8")).hexdigest()
+
+    def _merge_text(self, left: str, right: str) -> str:
+        """Склеивает соседние чанки, убирая общий фрагмент на стыке"""
+        for size in range(min(len(left), len(right), self.max_overlap), self.min_overlap - 1, -1):
+            if left.endswith(right[:size]):
+                return left + right[size:]
+        return left + "\n" + right
+
+    def pack(self, search_result: SearchResult) -> SearchResult:
+        documents = search_result.documents
+        scores = search_result.scores or [1.0 - i / max(len(documents), 1) for i in range(len(documents))]
+        ranked = sorted(zip(documents, scores), key=lambda pair: pair[1], reverse=True)
+        
+        selected: List[Tuple[Document, float]] = []
+        seen = set()
+        used_tokens = 0
+        for doc, score in ranked:
+            fingerprint = self._fingerprint(doc.page_content)
+            if fingerprint in seen:
+                continue
+            cost = _estimate_tokens(doc.page_content)
+            if used_tokens + cost > self.token_budget:
+                continue
+            seen.add(fingerprint)
+            selected.append((doc, score))
+            used_tokens += cost
+            if self.token_budget - used_tokens < 50:
+                break
+        
+        groups: Dict[Tuple[str, str], List[Tuple[Document, float]]] = {}
+        for doc, score in selected:
+            key = (doc.metadata.get("type"), doc.metadata.get("relative_path"))
+            groups.setdefault(key, []).append((doc, score))
+        
+        packed: List[Tuple[Document, float]] = []
+        for group in groups.values():
+            group.sort(key=lambda pair: pair[0].metadata.get("chunk_index", 0))
+            run_doc, run_score = group[0]
+            run_text, run_indices = run_doc.page_content, [run_doc.metadata.get("chunk_index")]
+            for doc, score in group[1:]:
+                index = doc.metadata.get("chunk_index")
+                if index is not None and run_indices[-1] is not None and index == run_indices[-1] + 1:
+                    run_text = self._merge_text(run_text, doc.page_content)
+                    run_indices.append(index)
+                    run_score = max(run_score, score)
+                    continue
+                packed.append(self._merged_document(run_doc, run_text, run_indices, run_score))
+                run_doc, run_score = doc, score
+                run_text, run_indices = doc.page_content, [index]
+            packed.append(self._merged_document(run_doc, run_text, run_indices, run_score))
+        
+        packed.sort(key=lambda pair: pair[1], reverse=True)
+        counters = dict(search_result.counters)
+        counters["packed_documents"] = len(packed)
+        counters["context_tokens"] = sum(_estimate_tokens(doc.page_content) for doc, _ in packed)
+        return SearchResult(
+            documents=[doc for doc, _ in packed],
+            search_type=search_result.search_type,
+            primary_chunks=search_result.primary_chunks,
+            related_chunks=search_result.related_chunks,
+            scores=[score for _, score in packed],
+            timings=dict(search_result.timings),
+            counters=counters,
+            code_ratio=search_result.code_ratio
+        )
+
+    @staticmethod
+    def _merged_document(first: Document, text: str, indices: list, score: float) -> Tuple[Document, float]:
+        if len(indices) == 1:
+            return first, score
+        metadata = dict(first.metadata)
+        metadata["merged_chunk_indices"] = indices
+        return Document(page_content=text, metadata=metadata, id=first.id), score
+
+
+class AnswerCache:
+    """Кэш ответов LLM в SQLite.
+
+    Ключ — нормализованный вопрос, идентификаторы чанков контекста и версия
+    индекса. При смене версии индекса старые записи удаляются, размер кэша
+    ограничен max_entries (вытесняются давно не использованные ответы).
+    """
+
+    def __init__(self, db_path: str = ":memory:", max_entries: int = 1000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._index_version: Optional[str] = None
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS answers "
+            "(key TEXT PRIMARY KEY, index_version TEXT NOT NULL, answer TEXT NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def key(question: str, documents: List[Document], index_version: Optional[str]) -> str:
+        digest = hashlib.sha256()
+        digest.update(" ".join(question.casefold().split()).encode("utf-8"))
+        for doc in documents:
+            chunk_id = doc.id or _chunk_id(doc.metadata)
+            merged = doc.metadata.get("merged_chunk_indices")
+            digest.update(f"\0{chunk_id}{merged or ''}".encode("utf-8"))
+        digest.update(f"\0{index_version}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def sync_version(self, index_version: Optional[str]):
+        """Удаляет ответы, полученные на другой версии индекса"""
+        with self._lock:
+            if index_version == self._index_version:
+                return
+            self._db.execute("DELETE FROM answers WHERE index_version != ?", (str(index_version),))
+            self._db.commit()
+            self._index_version = index_version
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT answer FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE answers SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, index_version: Optional[str], answer: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO answers (key, index_version, answer, last_access) VALUES (?, ?, ?, ?)",
+                (key, str(index_version), answer, time.time())
+            )
+            self._db.execute(
+                "DELETE FROM answers WHERE key IN "
+                "(SELECT key FROM answers ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM answers")
+            self._db.commit()
+
+    def cache_info(self) -> Dict[str, int]:
+        with self._lock:
+            size = self._db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "size": size}
+
+
+class RetrievalMetrics:
+    """Накопительные метрики запросов для мониторинга.
+
+    Длительности этапов из SearchResult.timings собираются в гистограммы,
+    counters суммируются. render_prometheus отдает их в текстовом формате
+    Prometheus; при заданном log_path каждый запрос дополнительно пишется
+    строкой JSON.
+    """
+
+    BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+    # Счетчики запросов, которые относятся к кэшам и выводятся как {prefix}_cache_hits_total{cache=...}
+    CACHE_COUNTERS = {"embedding_cache_hits": "embedding", "answer_cache_hits": "answer"}
+
+    def __init__(self, log_path: Optional[str] = None, prefix: str = "rag"):
+        self.log_path = log_path
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._requests: Counter = Counter()
+        self._counters: Counter = Counter()
+        self._histograms: Dict[str, dict] = {}
+
+    def observe(self, search_result: SearchResult):
+        with self._lock:
+            self._requests[search_result.search_type] += 1
+            for stage, ms in search_result.timings.items():
+                histogram = self._histograms.setdefault(
+                    stage, {"buckets": [0] * len(self.BUCKETS_MS), "sum": 0.0, "count": 0}
+                )
+                for i, bound in enumerate(self.BUCKETS_MS):
+                    if ms <= bound:
+                        histogram["buckets"][i] += 1
+                histogram["sum"] += ms
+                histogram["count"] += 1
+            self._counters.update(search_result.counters)
+            
+            if self.log_path:
+                record = {
+                    "ts": round(time.time(), 3),
+                    "search_type": search_result.search_type,
+                    "timings_ms": {stage: round(ms, 3) for stage, ms in search_result.timings.items()},
+                    "counters": search_result.counters,
+                }
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def render_prometheus(self, gauges: Optional[Dict[str, float]] = None,
+                          caches: Optional[Dict[str, Dict[str, int]]] = None) -> str:
+        """Метрики в текстовом формате Prometheus.
+
+        gauges — дополнительные мгновенные значения. caches — cache_info() кэшей
+        по имени: попадания и промахи выводятся счетчиками
+        {prefix}_cache_hits_total / {prefix}_cache_misses_total с меткой cache,
+        размер — gauge {prefix}_cache_size. Для кэша без cache_info попадания
+        берутся из счетчиков запросов.
+        """
+        prefix = self.prefix
+        caches = caches or {}
+        with self._lock:
+            lines = [f"# TYPE {prefix}_requests_total counter"]
+            for search_type, count in sorted(self._requests.items()):
+                lines.append(f'{prefix}_requests_total{{search_type="{search_type}"}} {count}')
+            
+            lines.append(f"# TYPE {prefix}_stage_duration_ms histogram")
+            for stage, histogram in sorted(self._histograms.items()):
+                for bound, count in zip(self.BUCKETS_MS, histogram["buckets"]):
+                    lines.append(f'{prefix}_stage_duration_ms_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{prefix}_stage_duration_ms_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'{prefix}_stage_duration_ms_sum{{stage="{stage}"}} {histogram["sum"]:.3f}')
+                lines.append(f'{prefix}_stage_duration_ms_count{{stage="{stage}"}} {histogram["count"]}')
+            
+            cache_hits = {}
+            for name, value in sorted(self._counters.items()):
+                if name in self.CACHE_COUNTERS:
+                    cache_hits[self.CACHE_COUNTERS[name]] = value
+                    continue
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+        
+        cache_hits.update({cache: info["hits"] for cache, info in caches.items() if "hits" in info})
+        cache_misses = {cache: info["misses"] for cache, info in caches.items() if "misses" in info}
+        cache_sizes = {cache: info["size"] for cache, info in caches.items() if "size" in info}
+        for family, kind, values in (("cache_hits_total", "counter", cache_hits),
+                                     ("cache_misses_total", "counter", cache_misses),
+                                     ("cache_size", "gauge", cache_sizes)):
+            if values:
+                lines.append(f"# TYPE {prefix}_{family} {kind}")
+                lines.extend(f'{prefix}_{family}{{cache="{cache}"}} {value}' for cache, value in sorted(values.items()))
+        
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
 
 class SmartRetriever(BaseRetriever):
     """Ретривер для LangChain, использующий умный поиск"""
     
     smart_system: SmartCodeDocSystem = Field(description="Smart code documentation system")
     k: int = Field(default=6, description="Number of documents to retrieve")
+    token_budget: Optional[int] = Field(default=None, description="Context token budget for packing")
     
     def __init__(self, smart_system: SmartCodeDocSystem, k: int = 6, **kwargs):
         super().__init__(smart_system=smart_system, k=k, **kwargs)
     
+    def search(self, query: str) -> SearchResult:
+        """Выполняет умный поиск и возвращает полный результат с метаданными"""
+        return self.pack(self.smart_system.smart_search(query, k=self.k))
+
+    async def asearch(self, query: str) -> SearchResult:
+        """Асинхронная версия search"""
+        return self.pack(await self.smart_system.asmart_search(query, k=self.k))
+
+    def pack(self, search_result: SearchResult) -> SearchResult:
+        if self.token_budget is None:
+            return search_result
+        start = time.perf_counter()
+        packed = ContextPacker(self.token_budget).pack(search_result)
+        packed.timings["pack"] = _elapsed_ms(start)
+        return packed
+
     def _get_relevant_documents(self, query: str, **kwargs) -> List[Document]:
-        search_result = self.smart_system.smart_search(query, k=self.k)
-        return search_result.documents
+        return self.search(query).documents
     
     async def _aget_relevant_documents(self, query: str, **kwargs) -> List[Document]:
-        return self._get_relevant_documents(query, **kwargs)
+        return (await self.asearch(query)).documents
+
+
+def _prompt_assembly_ms(run) -> float:
+    """Время шагов трассы document_chain до вызова модели (форматирование контекста и промпта)"""
+    total = 0.0
+    for child in sorted(run.child_runs, key=lambda child: child.start_time):
+        if child.run_type in ("llm", "chat_model"):
+            break
+        if child.end_time is not None:
+            total += (child.end_time - child.start_time).total_seconds() * 1000
+    return total
+
+
+def _run_steps_ms(run) -> float:
+    """Суммарное время шагов трассы (или самой трассы, если шагов нет)"""
+    if not run.child_runs:
+        return 0.0 if run.end_time is None else (run.end_time - run.start_time).total_seconds() * 1000
+    return sum(
+        (child.end_time - child.start_time).total_seconds() * 1000
+        for child in run.child_runs if child.end_time is not None
+    )
+
+
+def record_answer(search_result: SearchResult, question: str, answer: str, generation_ms: Optional[float],
+                  cached: Optional[bool] = None, run=None):
+    """Записывает в search_result время генерации и оценку токенов запроса и ответа.
+
+    Если передана трасса run вызова document_chain, сборка промпта выделяется
+    из generation_ms в отдельный этап prompt. При generation_ms=None время
+    берется из самой трассы как сумма ее шагов: batch выполняет цепочку по шагам
+    для всех входов сразу, и конец run у всех вопросов пакета совпадает.
+    """
+    if generation_ms is None:
+        generation_ms = 0.0 if run is None else _run_steps_ms(run)
+    if run is not None:
+        prompt_ms = min(_prompt_assembly_ms(run), generation_ms)
+        search_result.timings["prompt"] = prompt_ms
+        generation_ms -= prompt_ms
+    search_result.timings["generation"] = generation_ms
+    search_result.counters["tokens_in"] = _estimate_tokens(question) + sum(
+        _estimate_tokens(doc.page_content) for doc in search_result.documents
+    )
+    search_result.counters["tokens_out"] = _estimate_tokens(answer)
+    if cached is not None:
+        search_result.counters["answer_cache_hits"] = int(cached)
+
+
+def create_smart_retrieval_chain(retriever: SmartRetriever, document_chain: Runnable,
+                                 answer_cache: Optional[AnswerCache] = None,
+                                 metrics: Optional[RetrievalMetrics] = None) -> Runnable:
+    """Создает цепочку, которая выполняет поиск один раз.
+
+    Возвращает словарь с ключами input, search_result, context и answer,
+    поэтому вызывающему коду не нужно повторять smart_search.
+    С answer_cache повторный вопрос с тем же контекстом не доходит до LLM.
+    Время сборки промпта и генерации и оценки токенов записываются в
+    search_result и, если задан metrics, учитываются в нем по завершении ответа.
+    """
+    async def aretrieve(inputs: dict) -> SearchResult:
+        return await retriever.asearch(inputs["input"])
+
+    retrieve = RunnableLambda(
+        lambda inputs: retriever.search(inputs["input"]), afunc=aretrieve
+    ).with_config(run_name="smart_search")
+
+    def generate(inputs: dict):
+        start = time.perf_counter()
+
+        def finish(answer: str, cached: Optional[bool], run=None):
+            record_answer(inputs["search_result"], inputs["input"], answer, _elapsed_ms(start), cached, run)
+            if metrics is not None:
+                metrics.observe(inputs["search_result"])
+
+        key = index_version = None
+        if answer_cache is not None:
+            index_version = retriever.smart_system.index_version
+            answer_cache.sync_version(index_version)
+            key = answer_cache.key(inputs["input"], inputs["context"], index_version)
+            cached = answer_cache.get(key)
+            if cached is not None:
+                finish(cached, True)
+                return cached
+
+        def on_end(run):
+            answer = run.outputs["output"]
+            if answer_cache is not None:
+                answer_cache.put(key, index_version, answer)
+            finish(answer, None if answer_cache is None else False, run)
+
+        return document_chain.with_listeners(on_end=on_end)
+
+    answer = RunnableLambda(generate).with_config(run_name="generate_answer")
+
+    return (
+        RunnablePassthrough.assign(search_result=retrieve)
+        .assign(context=lambda inputs: inputs["search_result"].documents)
+        .assign(answer=answer)
+    ).with_config(run_name="smart_retrieval_chain")
 
 
 def create_smart_prompt() -> ChatPromptTemplate: